@@ -0,0 +1,407 @@
+import io
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+
+import pdf_motor
+import drive_client
+import drive_metrics
+from fake_drive import FakeDriveService
+
+# Kör: python benchmark.py [latens i sekunder per anrop] [--repeat N] [--json resultat.json] [--compare förra.json]
+#
+# Alla mappar byggs med seedad slump och varje mätning körs --repeat gånger mot en nybyggd
+# tjänst; medianen rapporteras. Med --json sparas resultaten och med --compare visas skillnaden
+# mot en tidigare körning.
+
+FOLDER_SIZES = (10, 100, 1000)
+SEED = 1234
+
+
+def build_story_folder(service, file_count):
+    folder_id = service.add_folder(f"berättelse_{file_count}")
+    filenames = []
+    for i in range(file_count):
+        if i % 2:
+            filename = f"bild_{i:04}.jpg"
+            service.add_file(filename, b'\xff\xd8\xff', parent_id=folder_id, mime_type='image/jpeg')
+        else:
+            filename = f"text_{i:04}.txt"
+            service.add_file(filename, f"Bildtext nummer {i}".encode('utf-8'), parent_id=folder_id, mime_type='text/plain')
+        filenames.append(filename)
+    order = json.dumps({'order': list(reversed(filenames))}).encode('utf-8')
+    service.add_file(pdf_motor.PROJECT_FILE_NAME, order, parent_id=folder_id, mime_type='application/json')
+    return folder_id
+
+
+def make_scan(rng, width=1240, height=1754, quality=85):
+    """Syntetisk skannad A4-sida i 150 dpi. Bruset ger en JPEG-storlek som liknar en riktig skanning."""
+    from PIL import Image, ImageDraw
+    channels = [Image.effect_noise((width, height), 40).point(lambda value, shift=rng.randint(60, 110): min(255, value + shift)) for _ in range(3)]
+    image = Image.merge('RGB', channels)
+    draw = ImageDraw.Draw(image)
+    for line in range(rng.randint(10, 30)):
+        y = 120 + line * 50
+        draw.line((100, y, rng.randint(300, width - 100), y), fill=(40, 40, 40), width=6)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def make_pdf(rng, page_count):
+    import fitz
+    document = fitz.open()
+    for page_number in range(page_count):
+        page = document.new_page()
+        page.insert_text((72, 72), f"Sida {page_number + 1} av {page_count}", fontsize=18)
+        for line in range(rng.randint(5, 25)):
+            page.insert_text((72, 110 + line * 22), f"Rad {line}: " + "abcdefghij " * rng.randint(2, 6))
+    return document.tobytes()
+
+
+def build_scan_folder(service, scans=40, texts=20, pdfs=4, pdf_pages=10, seed=SEED):
+    """Berättelsemapp med skanningar, bildtexter och flersidiga PDF:er i blandad ordning."""
+    rng = random.Random(seed)
+    folder_id = service.add_folder(f"skanningar_{scans}")
+    kinds = ['scan'] * scans + ['text'] * texts + ['pdf'] * pdfs
+    rng.shuffle(kinds)
+    for i, kind in enumerate(kinds):
+        if kind == 'scan':
+            service.add_file(f"skanning_{i:04}.jpg", make_scan(rng), parent_id=folder_id, mime_type='image/jpeg')
+        elif kind == 'text':
+            service.add_file(f"text_{i:04}.txt", f"Bildtext {i}: {'text ' * rng.randint(5, 60)}".encode('utf-8'), parent_id=folder_id, mime_type='text/plain')
+        else:
+            service.add_file(f"dokument_{i:04}.pdf", make_pdf(rng, pdf_pages), parent_id=folder_id, mime_type='application/pdf')
+    return folder_id
+
+
+def measure(setup, run, repeat):
+    """Kör run(*setup()) repeat gånger. Returnerar mediantid och medianantal anrop för run, plus sista resultatet."""
+    times, requests, result = [], [], None
+    for _ in range(repeat):
+        service, *args = setup()
+        service.reset_counters()
+        start = time.perf_counter()
+        result = run(service, *args)
+        times.append(time.perf_counter() - start)
+        requests.append(service.request_count)
+    return {'seconds': round(statistics.median(times), 4), 'requests': statistics.median(requests)}, result
+
+
+def report(results, name, measurement, extra=''):
+    results[name] = measurement
+    print(f"  {name:<40} {measurement['seconds']:8.3f} s, {measurement['requests']:>6} anrop{extra}")
+
+
+def bench_get_content_units(results, latency, repeat):
+    print(f"get_content_units_from_folder (latens {latency * 1000:.0f} ms per anrop)")
+    for file_count in FOLDER_SIZES:
+        def setup():
+            service = FakeDriveService(latency=latency)
+            return service, build_story_folder(service, file_count)
+        measurement, result = measure(setup, pdf_motor.get_content_units_from_folder, repeat)
+        assert len(result['units']) == file_count, result
+        report(results, f"get_content_units[{file_count}]", measurement)
+
+
+def bench_paginated_listing(results, latency, file_count=5000, page_size=1000):
+    print(f"iter_content_units_from_folder ({file_count} filer, {page_size} per sida)")
+    service = FakeDriveService(latency=latency)
+    folder_id = build_story_folder(service, file_count)
+    service.reset_counters()
+    start = time.perf_counter()
+    pages, unit_count, first_page_at = 0, 0, None
+    for result in pdf_motor.iter_content_units_from_folder(service, folder_id, page_size=page_size):
+        if 'units' in result:
+            pages += 1
+            unit_count += len(result['units'])
+            first_page_at = first_page_at or time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    assert unit_count == file_count, unit_count
+    assert pages == -(-(file_count + 1) // page_size), pages
+    report(results, f"paginated_listing[{file_count}]", {'seconds': round(elapsed, 4), 'requests': service.request_count},
+           f", {pages} sidor, första sidan efter {first_page_at:.3f} s")
+
+
+def bench_short_pages(results, latency, file_count=1000, max_page_size=100):
+    print(f"get_content_units_from_folder när Drive ger högst {max_page_size} filer per sida")
+    service = FakeDriveService(latency=latency, max_page_size=max_page_size)
+    folder_id = build_story_folder(service, file_count)
+    measurement, result = measure(lambda: (service, folder_id), pdf_motor.get_content_units_from_folder, 1)
+    assert len(result['units']) == file_count, result
+    report(results, f"short_pages[{file_count}]", measurement)
+
+
+def bench_cached_reload(results, latency, file_count=1000):
+    print(f"get_content_units_from_folder med DriveCache ({file_count} filer)")
+    service = FakeDriveService(latency=latency)
+    folder_id = build_story_folder(service, file_count)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = pdf_motor.DriveCache(os.path.join(cache_dir, 'cache.sqlite'))
+        cache.sync(service)
+        for label in ('kall', 'varm'):
+            service.reset_counters()
+            start = time.perf_counter()
+            cache.sync(service)
+            result = pdf_motor.get_content_units_from_folder(service, folder_id, cache=cache)
+            elapsed = time.perf_counter() - start
+            assert len(result['units']) == file_count
+            report(results, f"cached_reload[{label}]", {'seconds': round(elapsed, 4), 'requests': service.request_count})
+
+
+def build_folder_hierarchy(service, depth=5, breadth=4):
+    """Bygger ett mappträd med breadth undermappar per nivå och returnerar den djupaste vägen."""
+    path, level = [], ['root']
+    for _ in range(depth):
+        level = [service.add_folder(f"Mapp {parent}-{index:02d}", parent) for parent in level for index in range(breadth)]
+        path.append(level[-1])
+    # Vägen går genom sista mappen på varje nivå, vars förälder är sista mappen på nivån ovanför
+    return path
+
+
+def bench_folder_navigation(results, latency, depth=5, breadth=4):
+    print(f"Navigering {depth} nivåer ned i ett mappträd ({sum(breadth ** level for level in range(1, depth + 1))} mappar)")
+    service = FakeDriveService(latency=latency)
+    path = build_folder_hierarchy(service, depth, breadth)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = pdf_motor.DriveCache(os.path.join(cache_dir, 'cache.sqlite'))
+        for label in ('list_folders', 'folder_tree'):
+            service.reset_counters()
+            start = time.perf_counter()
+            tree = None
+            for folder_id in ['root'] + path:
+                if label == 'list_folders':
+                    assert 'error' not in pdf_motor.list_folders(service, folder_id)
+                else:
+                    tree = pdf_motor.load_folder_tree(service, 'root', cache=cache, current=tree)
+                    tree.children(folder_id)
+                    tree.path(folder_id)
+            elapsed = time.perf_counter() - start
+            assert tree is None or len(tree.path(path[-1])) == depth - 1
+            report(results, f"folder_navigation[{label}]", {'seconds': round(elapsed, 4), 'requests': service.request_count})
+        service.reset_counters()
+        start = time.perf_counter()
+        matches = tree.search('-03')
+        elapsed = time.perf_counter() - start
+        assert matches and service.request_count == 0
+        report(results, "folder_search", {'seconds': round(elapsed, 4), 'requests': service.request_count}, f" ({len(matches)} träffar)")
+
+
+def bench_action_metrics(results, latency, file_count=1000):
+    print(f"Anrop per metod vid inläsning ({file_count} filer, drive_metrics)")
+    service = FakeDriveService(latency=latency)
+    folder_id = build_story_folder(service, file_count)
+    with drive_metrics.measure('reload') as action:
+        pdf_motor.get_content_units_from_folder(service, folder_id)
+    summary = action.summary()
+    assert summary['calls'] == service.request_count, (summary['calls'], service.request_count)
+    report(results, "action_metrics[total]", {'seconds': round(summary['duration_ms'] / 1000, 4), 'requests': summary['calls']})
+    for method, stats in summary['methods'].items():
+        # p50 jämförs mellan körningar; övriga percentiler och byte följer med i --json
+        measurement = {'seconds': round(stats['p50_ms'] / 1000, 4), 'requests': stats['calls'], 'p90_ms': stats['p90_ms'], 'p99_ms': stats['p99_ms'], 'bytes_received': stats['bytes_received']}
+        report(results, f"action_metrics[{method}]", measurement, f", p90 {stats['p90_ms']:6.1f} ms, p99 {stats['p99_ms']:6.1f} ms, {stats['bytes_received'] / 1024:7.1f} kB")
+
+
+def bench_injected_errors(results, latency, repeat, file_count=200, error_rate=0.05):
+    print(f"get_content_units_from_folder med {error_rate:.0%} injicerade 503-fel ({file_count} filer)")
+    retries = []
+    def setup():
+        service = FakeDriveService(latency=latency, error_rate=error_rate, seed=SEED)
+        return service, build_story_folder(service, file_count)
+    def run(service, folder_id):
+        with drive_metrics.measure('reload') as action:
+            result = pdf_motor.get_content_units_from_folder(service, folder_id)
+        retries.append(action.summary()['retries'])
+        return result
+    measurement, result = measure(setup, run, repeat)
+    assert len(result['units']) == file_count, result
+    measurement['retries'] = statistics.median(retries)
+    report(results, f"injected_errors[{file_count}]", measurement, f", {measurement['retries']} omförsök")
+
+
+def bench_save_story_order(results, latency, repeat, file_count=1000, edits=10):
+    print(f"save_story_order ({file_count} objekt)")
+    def setup():
+        service = FakeDriveService(latency=latency)
+        folder_id = build_story_folder(service, file_count)
+        loaded = pdf_motor.get_content_units_from_folder(service, folder_id)
+        return service, folder_id, loaded['units'][::-1], loaded['project_file']
+    def save_lookup(service, folder_id, units, project_file):
+        return pdf_motor.save_story_order(service, folder_id, units)
+    def save_known(service, folder_id, units, project_file):
+        return pdf_motor.save_story_order(service, folder_id, units, project_file_id=project_file['id'], expected_version=pdf_motor._file_version(project_file))
+    def save_debounced(service, folder_id, units, project_file):
+        writer = pdf_motor.StoryOrderWriter(service, folder_id, project_file, delay=60)
+        for i in range(edits):
+            writer.schedule(units[i:] + units[:i])
+        return writer.flush()
+    for name, run in (("save_story_order[slå upp filen]", save_lookup), ("save_story_order[känd version]", save_known), (f"StoryOrderWriter[{edits} ändringar]", save_debounced)):
+        measurement, result = measure(setup, run, repeat)
+        assert 'success' in result, result
+        report(results, name, measurement)
+
+
+def bench_split(results, latency, repeat, page_count=60):
+    print(f"split_pdf_and_upload ({page_count} sidor)")
+    pdf_bytes = make_pdf(random.Random(SEED), page_count)
+    def setup():
+        service = FakeDriveService(latency=latency)
+        folder_id = service.add_folder('dela')
+        return service, service.add_file('register.pdf', pdf_bytes, parent_id=folder_id, mime_type='application/pdf'), folder_id
+    def split(service, file_id, folder_id):
+        return pdf_motor.split_pdf_and_upload(service, file_id, 'register.pdf', folder_id)
+    measurement, result = measure(setup, split, repeat)
+    assert len(result['new_files']) == page_count, result
+    report(results, f"split[{page_count}]", measurement)
+    def setup_interrupted():
+        service, file_id, folder_id = setup()
+        # Ett fel som inte provas om gör att en sida saknas; övriga uppladdningar hinner bli klara
+        service.fail_next(400, method='drive.files.create', after=page_count // 2)
+        assert 'error' in split(service, file_id, folder_id)
+        return service, file_id, folder_id
+    measurement, result = measure(setup_interrupted, split, repeat)
+    assert len(result['new_files']) == page_count and result['resumed_pages'], result
+    report(results, f"split_resume[{page_count}]", measurement, f", {result['resumed_pages']} sidor återanvända")
+
+
+def scan_folder_files():
+    """Innehållet i build_scan_folder, så att mätningar kan bygga om mappen utan att skapa bilderna igen."""
+    source = FakeDriveService()
+    folder_id = build_scan_folder(source)
+    return [(file['name'], source._content(file), file['mimeType']) for file in source._files.values() if file['parents'] == [folder_id]]
+
+
+def add_files(service, name, files, parent_id='root'):
+    folder_id = service.add_folder(name, parent_id)
+    for filename, content, mime_type in files:
+        service.add_file(filename, content, parent_id=folder_id, mime_type=mime_type)
+    return folder_id
+
+
+def bench_album(results, latency, repeat, files):
+    print("generate_pdfs_from_story (skanningar, texter och flersidiga PDF:er)")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        def setup():
+            service = FakeDriveService(latency=latency)
+            units = pdf_motor.get_content_units_from_folder(service, add_files(service, 'album', files))['units']
+            return service, units, pdf_motor.ImageCache(tempfile.mkdtemp(dir=cache_dir), max_bytes=pdf_motor.ALBUM_IMAGE_CACHE_MAX_BYTES)
+        def generate(service, units, image_cache):
+            return pdf_motor.generate_pdfs_from_story(service, units, {'max_mb': 5.0}, image_cache=image_cache, output_dir=tempfile.mkdtemp(dir=cache_dir))
+        def setup_warm():
+            service, units, image_cache = setup()
+            generate(service, units, image_cache)
+            return service, units, image_cache
+        for name, album_setup in (("album[kall]", setup), ("album[varm bildcache]", setup_warm)):
+            measurement, result = measure(album_setup, generate, repeat)
+            assert 'pdfs' in result, result
+            report(results, name, measurement, f", {len(result['pdfs'])} PDF:er, {sum(pdf['size'] for pdf in result['pdfs']) / 1e6:.1f} MB")
+
+
+def bench_archive(results, latency, repeat, files, copies=3):
+    print(f"archive_folder (skanningsmappen i {copies} undermappar)")
+    def setup():
+        service = FakeDriveService(latency=latency)
+        folder_id = service.add_folder('källa', service.add_folder('projekt'))
+        for copy in range(copies):
+            add_files(service, f"del_{copy + 1}", files, folder_id)
+        return service, folder_id
+    measurement, result = measure(setup, lambda service, folder_id: pdf_motor.archive_folder(service, folder_id, 'källa'), repeat)
+    assert result.get('verified'), result
+    report(results, "archive_folder", measurement, f", {result['files']} filer, {result['bytes'] / 1e6:.1f} MB")
+
+
+def build_image_folder(service, file_count):
+    from PIL import Image
+    folder_id = service.add_folder(f"bilder_{file_count}")
+    for i in range(file_count):
+        if i % 2:
+            image = io.BytesIO()
+            Image.new('RGB', (64, 48), (i % 256, 80, 160)).save(image, format='JPEG')
+            service.add_file(f"bild_{i:04}.jpg", image.getvalue(), parent_id=folder_id, mime_type='image/jpeg')
+        else:
+            service.add_file(f"text_{i:04}.txt", f"Bildtext nummer {i}".encode('utf-8'), parent_id=folder_id, mime_type='text/plain')
+    return folder_id
+
+
+def bench_story_board_rerun(results, story_sizes=(100, 1000, 3000), reruns=3):
+    import logging
+    from streamlit.testing.v1 import AppTest
+    # AppTest körs utan riktig session, så dessa varningar är bara brus här
+    logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').addFilter(lambda record: False)
+    print("streamlit_app.py, tid per omkörning av berättelsevyn (Organisera-läge)")
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streamlit_app.py')
+    for story_size in story_sizes:
+        service = FakeDriveService()
+        folder_id = build_image_folder(service, story_size)
+        units = pdf_motor.get_content_units_from_folder(service, folder_id)['units']
+        app = AppTest.from_file(app_path, default_timeout=600)
+        app.secrets.update({'GOOGLE_CLIENT_ID': 'fake', 'GOOGLE_CLIENT_SECRET': 'fake', 'APP_URL': 'http://localhost'})
+        state = {'drive_service': service, 'user_email': 'bench@example.com', 'story_items': units, 'current_folder_id': folder_id, 'current_folder_name': 'bench', 'organize_mode': True,
+                 'current_drive': ('root', 'Min enhet'), 'path_history': [('root', 'Min enhet')]}
+        for key, value in state.items():
+            app.session_state[key] = value
+        app.run()  # första körningen bygger miniatyrcachen
+        service.reset_counters()
+        start = time.perf_counter()
+        for _ in range(reruns):
+            app.run()
+        elapsed = (time.perf_counter() - start) / reruns
+        assert not app.exception, app.exception
+        report(results, f"story_board_rerun[{story_size}]", {'seconds': round(elapsed, 4), 'requests': service.request_count / reruns})
+
+
+def compare(results, previous_path):
+    with open(previous_path, encoding='utf-8') as fh:
+        previous = json.load(fh)['results']
+    print(f"Jämfört med {previous_path}")
+    for name, measurement in results.items():
+        if name not in previous:
+            continue
+        before = previous[name]
+        change = (measurement['seconds'] - before['seconds']) / before['seconds'] * 100 if before['seconds'] else 0.0
+        requests = f", anrop {before['requests']} -> {measurement['requests']}" if before['requests'] != measurement['requests'] else ''
+        print(f"  {name:<40} {before['seconds']:8.3f} s -> {measurement['seconds']:8.3f} s ({change:+6.1f} %){requests}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prestandamätningar för pdf_motor mot en falsk Drive-tjänst.")
+    parser.add_argument('latency', nargs='?', type=float, default=0.02, help="simulerad latens i sekunder per anrop")
+    parser.add_argument('--repeat', type=int, default=3, help="antal körningar per mätning; medianen rapporteras")
+    parser.add_argument('--json', help="spara resultaten i den här filen")
+    parser.add_argument('--compare', help="jämför med resultat sparade med --json")
+    parser.add_argument('--skip-app', action='store_true', help="hoppa över mätningarna av streamlit_app.py")
+    args = parser.parse_args()
+
+    # Korta väntetider vid omförsök, annars domineras felinjektionen av slumpad backoff
+    drive_client.BACKOFF_BASE = 0.05
+    results = {}
+    bench_get_content_units(results, args.latency, args.repeat)
+    bench_paginated_listing(results, args.latency)
+    bench_short_pages(results, args.latency)
+    bench_cached_reload(results, args.latency)
+    bench_folder_navigation(results, args.latency)
+    bench_action_metrics(results, args.latency)
+    bench_injected_errors(results, args.latency, args.repeat)
+    bench_save_story_order(results, args.latency, args.repeat)
+    bench_split(results, args.latency, args.repeat)
+    files = scan_folder_files()
+    bench_album(results, args.latency, args.repeat, files)
+    bench_archive(results, args.latency, args.repeat, files)
+    if not args.skip_app:
+        bench_story_board_rerun(results)
+
+    if args.json:
+        environment = {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'latency': args.latency, 'repeat': args.repeat}
+        with open(args.json, 'w', encoding='utf-8') as fh:
+            json.dump({'environment': environment, 'results': results}, fh, indent=2, ensure_ascii=False)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# Gör modulerna i projektroten importerbara från tests/
@@ -0,0 +1,229 @@
+import json
+import time
+import random
+import socket
+import threading
+
+import httplib2
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+
+import drive_metrics
+
+# Trådsäker åtkomst till Drive. httplib2 är inte trådsäkert, så varje tråd får en egen
+# auktoriserad http-instans som behåller sina keep-alive-anslutningar mellan anropen.
+# Token förnyas på ett ställe under lås, och tillfälliga fel (429, 5xx, kvotfel) provas
+# om med exponentiell backoff och jitter. Vid 429 pausar alla trådar tillsammans.
+
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5  # sekunder före första omförsöket
+BACKOFF_MAX = 32.0
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+DAILY_LIMIT_REASONS = ('dailyLimitExceeded', 'quotaExceeded')
+PERMISSION_REASONS = ('forbidden', 'insufficientFilePermissions', 'insufficientPermissions', 'appNotAuthorizedToFile', 'cannotModifyFile')
+DOWNLOAD_POOL_WORKERS = 16
+UPLOAD_POOL_WORKERS = 8
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, socket.timeout, httplib2.ServerNotFoundError)
+
+_clients_lock = threading.Lock()
+_pools = {}
+
+
+def _error_reason(error):
+    try:
+        return error.error_details[0].get('reason') if error.error_details else None
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+
+def is_retryable(error):
+    """Sant för fel som brukar gå över av sig själva: kvot, tillfälliga serverfel och nätverksavbrott."""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        return status in RETRY_STATUS_CODES or (status == 403 and _error_reason(error) in RATE_LIMIT_REASONS)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def error_message(error):
+    """Begriplig text för användaren i stället för HttpErrors råa svar."""
+    if not isinstance(error, HttpError):
+        return str(error)
+    status = error.resp.status
+    if status == 429 or (status == 403 and _error_reason(error) in RATE_LIMIT_REASONS):
+        return "Google Drive begränsar just nu antalet anrop. Försök igen om en stund."
+    if status >= 500:
+        return f"Google Drive svarar inte just nu (fel {status}). Försök igen om en stund."
+    if status == 401:
+        return "Inloggningen har gått ut. Logga in igen."
+    if status == 403:
+        reason = _error_reason(error)
+        if reason == 'storageQuotaExceeded':
+            return "Lagringsutrymmet i Google Drive är fullt. Frigör utrymme och försök igen."
+        if reason in DAILY_LIMIT_REASONS:
+            return "Dagskvoten för anrop till Google Drive är slut. Försök igen i morgon."
+        if reason is None or reason in PERMISSION_REASONS:
+            return "Du saknar behörighet till filen eller mappen."
+        return f"Google Drive nekade åtgärden ({reason})."
+    if status == 404:
+        return "Filen eller mappen hittades inte. Den kan ha flyttats eller tagits bort."
+    return f"Google Drive svarade med fel {status}: {error.reason}"
+
+
+class DriveClient:
+    """Delas av alla trådar som använder samma Drive-tjänst; se client_for()."""
+
+    def __init__(self, credentials=None, max_retries=MAX_RETRIES):
+        self.credentials = credentials
+        self.max_retries = max_retries
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._pause_lock = threading.Lock()
+        self._paused_until = 0.0
+
+    def http(self):
+        """Trådens egen http-instans, eller None för tjänster utan inloggning (t.ex. FakeDriveService)."""
+        if self.credentials is None:
+            return None
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            import google_auth_httplib2
+            # 401 hanteras i execute() så att förnyelsen sker en gång i stället för i varje tråd
+            http = self._local.http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=build_http(), refresh_status_codes=())
+        return http
+
+    def refresh(self, stale_token=None):
+        """Förnyar token om den har gått ut. Med stale_token förnyas bara om ingen annan tråd redan gjort det."""
+        if self.credentials is None or (stale_token is None and self.credentials.valid):
+            return
+        with self._refresh_lock:
+            if stale_token is not None and self.credentials.token != stale_token:
+                return
+            if stale_token is not None or not self.credentials.valid:
+                from google.auth.transport.requests import Request
+                self.credentials.refresh(Request())
+
+    def call(self, fn, method='okänt', sent=0, size=None, max_retries=None):
+        """Anropar fn(http) med omförsök; fn ska vara säker att köra igen efter ett tillfälligt fel.
+
+        Varje anrop rapporteras till drive_metrics med total tid, antal omförsök och byte.
+        size(resultat) ger antal mottagna byte; utan den uppskattas storleken från resultatet.
+        max_retries ersätter klientens gräns för anrop som inte får blockera länge.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        refreshed = False
+        start = time.perf_counter()
+        while True:
+            self._wait_for_pause()
+            self.refresh()
+            token = getattr(self.credentials, 'token', None)
+            try:
+                result = fn(self.http())
+                drive_metrics.record(method, time.perf_counter() - start, attempt, sent, (size or _response_size)(result))
+                return result
+            except HttpError as e:
+                if e.resp.status == 401 and not refreshed and self.credentials is not None:
+                    self.refresh(stale_token=token)
+                    refreshed = True
+                    continue
+                if not is_retryable(e) or attempt >= max_retries:
+                    drive_metrics.record(method, time.perf_counter() - start, attempt, sent, 0, error=e)
+                    raise
+                delay = self._backoff(attempt, e)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= max_retries:
+                    drive_metrics.record(method, time.perf_counter() - start, attempt, sent, 0, error=e)
+                    raise
+                delay = self._backoff(attempt, e)
+            attempt += 1
+            time.sleep(delay)
+
+    def execute(self, request, max_retries=None):
+        return self.call(lambda http: request.execute(http=http), method=_method_name(request), sent=_request_size(request), max_retries=max_retries)
+
+    def _backoff(self, attempt, error):
+        # "Full jitter": slumpad väntan upp till den exponentiella gränsen sprider ut trådarnas omförsök
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        if isinstance(error, HttpError):
+            retry_after = error.resp.get('retry-after')
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            if error.resp.status == 429 or _error_reason(error) in RATE_LIMIT_REASONS:
+                # Kvoten gäller hela kontot, så alla trådar får vänta i stället för att fortsätta trycka på
+                with self._pause_lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    def _wait_for_pause(self):
+        remaining = self._paused_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def _method_name(request):
+    # HttpRequest.methodId är t.ex. 'drive.files.list'
+    return (getattr(request, 'methodId', None) or 'okänt').removeprefix('drive.')
+
+
+def _request_size(request):
+    body = getattr(request, 'body', None) or b''
+    media = getattr(request, 'resumable', None)
+    return len(body) + (media.size() or 0 if media is not None else 0)
+
+
+def _response_size(result):
+    if isinstance(result, (bytes, bytearray, str)):
+        return len(result)
+    if isinstance(result, dict):
+        # JSON-svaret är redan avkodat, så storleken uppskattas från den kodade formen
+        return len(json.dumps(result))
+    return 0
+
+
+def client_for(service):
+    """Returnerar tjänstens DriveClient och skapar den vid första anropet."""
+    client = getattr(service, '_drive_client', None)
+    if client is None:
+        with _clients_lock:
+            client = getattr(service, '_drive_client', None)
+            if client is None:
+                credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+                client = service._drive_client = DriveClient(credentials)
+    return client
+
+
+def _shared_pool(name, max_workers):
+    with _clients_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = drive_metrics.ThreadPool(max_workers=max_workers, thread_name_prefix=f"drive-{name}")
+    return pool
+
+
+def download_pool():
+    """Långlivad trådpool för nedladdningar och listningar.
+
+    Trådarna lever vidare mellan operationerna, och med dem trådarnas http-instanser, så att
+    keep-alive-anslutningarna till Drive återanvänds i stället för att öppnas per operation.
+    Uppgifter i poolen får inte vänta på andra uppgifter i samma pool.
+    """
+    return _shared_pool('download', DOWNLOAD_POOL_WORKERS)
+
+
+def upload_pool():
+    """Som download_pool(), för uppladdningar; en uppladdning får vänta på nedladdningar men inte tvärtom."""
+    return _shared_pool('upload', UPLOAD_POOL_WORKERS)
+
+
+def build_service(credentials):
+    """Bygger Drive v3-tjänsten med en DriveClient som alla trådar delar."""
+    service = build('drive', 'v3', credentials=credentials, cache_discovery=False)
+    service._drive_client = DriveClient(credentials)
+    return service
+
+
+def execute(service, request, max_retries=None):
+    """Kör ett API-anrop på trådens egen anslutning, med omförsök vid tillfälliga fel."""
+    return client_for(service).execute(request, max_retries)
@@ -0,0 +1,121 @@
+import json
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Mätning av Drive-anrop per användaråtgärd (läs in mapp, dela upp, skapa album, omkörning ...).
+# drive_client rapporterar varje anrop till den åtgärd som är aktiv i anroparens kontext.
+# Avslutade åtgärder sparas i en kort historik för felsökningspanelen och loggas som en
+# JSON-rad, så att t.ex. ett extra list-anrop per omkörning syns som en siffra.
+
+METRICS_HISTORY = 100  # antal avslutade åtgärder som sparas
+PERCENTILES = (50, 90, 99)
+
+logger = logging.getLogger('drive_metrics')
+
+_current_action = contextvars.ContextVar('drive_action', default=None)
+_history = deque(maxlen=METRICS_HISTORY)
+_history_lock = threading.Lock()
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, round(percent / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class ActionMetrics:
+    """Samlar anropsstatistik för en användaråtgärd. Tål samtidiga anrop från flera trådar."""
+
+    def __init__(self, name, owner=None):
+        self.name = name
+        self.owner = owner
+        self.started = time.time()
+        self.finished = None
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, latency, retries=0, sent=0, received=0, error=None):
+        with self._lock:
+            if self.finished:
+                return
+            stats = self._methods.setdefault(method, {'calls': 0, 'retries': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0, 'latencies': []})
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['errors'] += 1 if error else 0
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+            stats['latencies'].append(latency)
+
+    def summary(self):
+        with self._lock:
+            methods = {}
+            for method, stats in sorted(self._methods.items()):
+                latencies = sorted(stats['latencies'])
+                methods[method] = {key: value for key, value in stats.items() if key != 'latencies'}
+                methods[method].update({f"p{percent}_ms": round(_percentile(latencies, percent) * 1000, 1) for percent in PERCENTILES})
+            totals = {key: sum(stats[key] for stats in methods.values()) for key in ('calls', 'retries', 'errors', 'bytes_sent', 'bytes_received')}
+            end = self.finished or time.time()
+            return {'action': self.name, 'owner': self.owner, 'started': self.started, 'duration_ms': round((end - self.started) * 1000, 1),
+                    'finished': self.finished is not None, **totals, 'methods': methods}
+
+
+def start_action(name, owner=None):
+    """Gör en ny åtgärd aktiv i den aktuella kontexten och returnerar den."""
+    action = ActionMetrics(name, owner)
+    _current_action.set(action)
+    return action
+
+
+def finish_action(action):
+    """Avslutar åtgärden, sparar den i historiken och loggar en sammanfattning."""
+    if action is None or action.finished:
+        return
+    with action._lock:
+        action.finished = time.time()
+    summary = action.summary()
+    with _history_lock:
+        _history.append(summary)
+    logger.info(json.dumps(summary, ensure_ascii=False))
+
+
+@contextmanager
+def measure(name, owner=None):
+    """Räknar alla Drive-anrop i blocket, även från trådpooler skapade med ThreadPool, till en åtgärd."""
+    action = ActionMetrics(name, owner)
+    token = _current_action.set(action)
+    try:
+        yield action
+    finally:
+        _current_action.reset(token)
+        finish_action(action)
+
+
+def record(method, latency, retries=0, sent=0, received=0, error=None):
+    """Anropas av drive_client efter varje anrop; anrop utanför en åtgärd räknas inte."""
+    action = _current_action.get()
+    if action is not None:
+        action.record(method, latency, retries, sent, received, error)
+
+
+def recent_actions(owner=None):
+    """Avslutade åtgärder, nyaste först; med owner bara de som hör till den användaren."""
+    with _history_lock:
+        actions = list(_history)
+    return [action for action in reversed(actions) if owner is None or action['owner'] == owner]
+
+
+def export_json(owner=None):
+    return json.dumps(recent_actions(owner), ensure_ascii=False, indent=2)
+
+
+class ThreadPool(ThreadPoolExecutor):
+    """ThreadPoolExecutor där arbetstrådarnas anrop räknas till samma åtgärd som anroparens."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,342 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import mimetypes
+import threading
+import itertools
+
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaUploadProgress
+
+# En minimal, lokal ersättare för den del av Drive v3-klienten som pdf_motor använder.
+# Används för benchmarks så att prestanda kan mätas utan ett riktigt Google-konto.
+# Filinnehåll kan ligga på disk (storage_dir eller en speglad lokal mapp med add_directory),
+# och latens, sidstorlek och fel kan ställas in. Slumpen är seedad så att körningar går att jämföra.
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+_QUERY_PARENT = re.compile(r"'([^']*)' in parents")
+_QUERY_NAME = re.compile(r"name = '([^']*)'")
+_QUERY_MIME = re.compile(r"mimeType = '([^']*)'")
+_QUERY_APP_PROPERTY = re.compile(r"appProperties has \{ key='([^']*)' and value='([^']*)' \}")
+
+
+class FakeRequest:
+    def __init__(self, drive, handler, method_id=None):
+        self._drive = drive
+        self._handler = handler
+        self.methodId = method_id
+
+    def execute(self, http=None, num_retries=0):
+        self._drive._record_request(self.methodId)
+        return self._handler()
+
+
+class FakeMediaHttp:
+    """Svarar på Range-förfrågningar så att MediaIoBaseDownload fungerar mot den falska tjänsten."""
+
+    _RANGE = re.compile(r"bytes=(\d+)-(\d+)")
+
+    def __init__(self, drive, file_id):
+        self._drive = drive
+        self._file_id = file_id
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        try:
+            self._drive._record_request('drive.files.get_media')
+        except HttpError as e:
+            # MediaIoBaseDownload läser statusen ur svaret i stället för att fånga undantag
+            return e.resp, e.content
+        content = self._drive._get_media(self._file_id)
+        match = self._RANGE.match((headers or {}).get('range', ''))
+        start, end = (int(match.group(1)), int(match.group(2)) + 1) if match else (0, len(content))
+        chunk = content[start:end]
+        return httplib2.Response({'status': 206, 'content-range': f"bytes {start}-{start + len(chunk) - 1}/{len(content)}"}), chunk
+
+
+class FakeMediaRequest(FakeRequest):
+    def __init__(self, drive, file_id):
+        super().__init__(drive, lambda: drive._get_media(file_id), 'drive.files.get_media')
+        self.uri = f"https://fake.invalid/files/{file_id}?alt=media"
+        self.headers = {}
+        self.http = FakeMediaHttp(drive, file_id)
+
+
+class FakeUploadRequest(FakeRequest):
+    """Återupptagbar uppladdning i bitar, med samma next_chunk()-gränssnitt som HttpRequest."""
+
+    def __init__(self, drive, body, media_body):
+        super().__init__(drive, None, 'drive.files.create')
+        self.resumable = media_body
+        self.resumable_progress = 0
+        self._body = body
+        self._received = bytearray()
+
+    def next_chunk(self, http=None, num_retries=0):
+        self._drive._record_request(self.methodId)
+        size = self.resumable.size()
+        data = self.resumable.getbytes(self.resumable_progress, self.resumable.chunksize())
+        self._received += data
+        self.resumable_progress += len(data)
+        # Som i HttpRequest: en kort bit, eller att den kända storleken nåtts, avslutar uppladdningen
+        if len(data) < self.resumable.chunksize() or (size is not None and self.resumable_progress >= size):
+            return None, self._drive._create(self._body, None, bytes(self._received))
+        return MediaUploadProgress(self.resumable_progress, size if size is not None else -1), None
+
+    def execute(self, http=None, num_retries=0):
+        response = None
+        while response is None:
+            _, response = self.next_chunk(http=http)
+        return response
+
+
+class FakeFiles:
+    def __init__(self, drive):
+        self._drive = drive
+
+    def list(self, q='', pageSize=100, pageToken=None, fields=None, **kwargs):
+        return FakeRequest(self._drive, lambda: self._drive._list(q, pageSize, pageToken), 'drive.files.list')
+
+    def get(self, fileId, fields=None, **kwargs):
+        return FakeRequest(self._drive, lambda: self._drive._get(fileId), 'drive.files.get')
+
+    def get_media(self, fileId, **kwargs):
+        return FakeMediaRequest(self._drive, fileId)
+
+    def create(self, body=None, media_body=None, fields=None, **kwargs):
+        if media_body is not None and media_body.resumable():
+            return FakeUploadRequest(self._drive, body or {}, media_body)
+        return FakeRequest(self._drive, lambda: self._drive._create(body or {}, media_body), 'drive.files.create')
+
+    def update(self, fileId, body=None, media_body=None, fields=None, **kwargs):
+        return FakeRequest(self._drive, lambda: self._drive._update(fileId, body or {}, media_body), 'drive.files.update')
+
+
+class FakeChanges:
+    def __init__(self, drive):
+        self._drive = drive
+
+    def getStartPageToken(self, **kwargs):
+        return FakeRequest(self._drive, lambda: {'startPageToken': str(len(self._drive._changes))}, 'drive.changes.getStartPageToken')
+
+    def list(self, pageToken, pageSize=100, fields=None, **kwargs):
+        return FakeRequest(self._drive, lambda: self._drive._list_changes(pageToken, pageSize), 'drive.changes.list')
+
+
+class FakeDrives:
+    def __init__(self, drive):
+        self._drive = drive
+
+    def list(self, **kwargs):
+        return FakeRequest(self._drive, lambda: {'drives': []}, 'drive.drives.list')
+
+
+class FakeDriveService:
+    """Drive-tjänst utan nätverk som räknar anrop och simulerar latens, sidstorlek och fel.
+
+    latency är sekunder per anrop, max_page_size sätter ett tak för pageSize (Drive ger
+    ibland färre träffar än begärt), error_rate är sannolikheten att ett anrop misslyckas
+    med någon av error_statuses. Med storage_dir sparas filinnehåll på disk i stället för i minnet.
+    """
+
+    def __init__(self, latency=0.0, max_page_size=1000, error_rate=0.0, error_statuses=(503,), seed=0, storage_dir=None):
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.storage_dir = storage_dir
+        self.request_count = 0
+        self.error_count = 0
+        self._random = random.Random(seed)
+        self._scheduled_errors = []
+        self._files = {}
+        self._ids = itertools.count(1)
+        self._changes = []
+        self._lock = threading.Lock()
+        if storage_dir: os.makedirs(storage_dir, exist_ok=True)
+
+    # --- Samma gränssnitt som googleapiclient ---
+
+    def files(self):
+        return FakeFiles(self)
+
+    def drives(self):
+        return FakeDrives(self)
+
+    def changes(self):
+        return FakeChanges(self)
+
+    # --- Hjälpfunktioner för att bygga testdata ---
+
+    def add_folder(self, name, parent_id='root'):
+        return self.add_file(name, parent_id=parent_id, mime_type=FOLDER_MIME_TYPE)
+
+    def add_file(self, name, content=b'', parent_id='root', mime_type='application/octet-stream', app_properties=None, path=None):
+        """Lägger till en fil med content, eller med innehållet i den lokala filen path (läses vid behov)."""
+        with self._lock:
+            file_id = f"fake{next(self._ids)}"
+            self._files[file_id] = {'id': file_id, 'name': name, 'mimeType': mime_type, 'parents': [parent_id], 'appProperties': dict(app_properties or {})}
+            if path is None:
+                path = self._store(file_id, content)
+            self._files[file_id]['path' if path else 'content'] = path or content
+            self._touch(self._files[file_id])
+        return file_id
+
+    def add_directory(self, directory, parent_id='root'):
+        """Speglar en lokal katalog med underkataloger som mappar i den falska tjänsten."""
+        folder_id = self.add_folder(os.path.basename(os.path.normpath(directory)), parent_id)
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if entry.is_dir():
+                self.add_directory(entry.path, folder_id)
+            elif entry.is_file():
+                mime_type = mimetypes.guess_type(entry.name)[0] or 'application/octet-stream'
+                self.add_file(entry.name, parent_id=folder_id, mime_type=mime_type, path=entry.path)
+        return folder_id
+
+    def fail_next(self, status=503, count=1, method=None, after=0):
+        """Låter count anrop (till method, t.ex. 'drive.files.list') misslyckas med status, efter after lyckade."""
+        with self._lock:
+            self._scheduled_errors.append({'status': status, 'method': method, 'count': count, 'after': after})
+
+    def reset_counters(self):
+        with self._lock:
+            self.request_count = 0
+            self.error_count = 0
+
+    # --- Intern logik ---
+
+    def _record_request(self, method=None):
+        with self._lock:
+            self.request_count += 1
+            status = self._pick_error(method)
+            if status: self.error_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if status:
+            reason = 'rateLimitExceeded' if status == 429 else 'backendError'
+            body = json.dumps({'error': {'code': status, 'message': 'Injicerat fel', 'errors': [{'reason': reason}]}}).encode('utf-8')
+            raise HttpError(httplib2.Response({'status': status}), body)
+
+    def _pick_error(self, method):
+        # Anropas med låset taget
+        for i, error in enumerate(self._scheduled_errors):
+            if error['method'] is None or error['method'] == method:
+                if error['after']:
+                    error['after'] -= 1
+                    return None
+                error['count'] -= 1
+                if not error['count']: del self._scheduled_errors[i]
+                return error['status']
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self._random.choice(self.error_statuses)
+        return None
+
+    def _store(self, file_id, content):
+        # Anropas med låset taget; utan storage_dir ligger innehållet kvar i minnet
+        if not self.storage_dir:
+            return None
+        path = os.path.join(self.storage_dir, file_id)
+        with open(path, 'wb') as fh:
+            fh.write(content)
+        return path
+
+    def _content(self, file):
+        if 'path' in file:
+            with open(file['path'], 'rb') as fh:
+                return fh.read()
+        return file['content']
+
+    def _touch(self, file):
+        # Anropas med låset taget när en fil skapats eller ändrats
+        content = self._content(file)
+        file['md5Checksum'] = hashlib.md5(content).hexdigest()
+        file['size'] = str(len(content))
+        file['modifiedTime'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + f".{len(self._changes):03}Z"
+        self._changes.append(file['id'])
+
+    def _metadata(self, file):
+        metadata = {key: value for key, value in file.items() if key not in ('content', 'path')}
+        if file['mimeType'].startswith('image/'):
+            metadata['thumbnailLink'] = f"https://fake.invalid/thumb/{file['id']}"
+        return metadata
+
+    def _list(self, q, page_size, page_token):
+        parent = _QUERY_PARENT.search(q)
+        name = _QUERY_NAME.search(q)
+        mime = _QUERY_MIME.search(q)
+        app_property = _QUERY_APP_PROPERTY.search(q)
+        skip_trashed = 'trashed = false' in q
+        with self._lock:
+            matches = [
+                self._metadata(file) for file in self._files.values()
+                if not (skip_trashed and file.get('trashed'))
+                and (not parent or parent.group(1) in file['parents'])
+                and (not name or file['name'] == name.group(1))
+                and (not mime or file['mimeType'] == mime.group(1))
+                and (not app_property or file['appProperties'].get(app_property.group(1)) == app_property.group(2))
+            ]
+        start = int(page_token or 0)
+        end = start + min(page_size, self.max_page_size)
+        response = {'files': matches[start:end]}
+        if end < len(matches):
+            response['nextPageToken'] = str(end)
+        return response
+
+    def _file(self, file_id):
+        # Anropas med låset taget
+        if file_id not in self._files:
+            body = json.dumps({'error': {'code': 404, 'message': f"File not found: {file_id}", 'errors': [{'reason': 'notFound'}]}}).encode('utf-8')
+            raise HttpError(httplib2.Response({'status': 404}), body)
+        return self._files[file_id]
+
+    def _get(self, file_id):
+        if file_id == 'root':
+            # Filerna i Min enhet har 'root' som förälder, så rotmappen får ID:t 'root'
+            return {'id': 'root', 'name': 'Min enhet', 'mimeType': 'application/vnd.google-apps.folder'}
+        with self._lock:
+            return self._metadata(self._file(file_id))
+
+    def _get_media(self, file_id):
+        with self._lock:
+            return self._content(self._file(file_id))
+
+    def _read_media(self, media_body):
+        return media_body.getbytes(0, media_body.size()) if media_body is not None else b''
+
+    def _create(self, body, media_body, content=None):
+        file_id = self.add_file(body.get('name', 'namnlös'), self._read_media(media_body) if content is None else content, (body.get('parents') or ['root'])[0], body.get('mimeType') or (media_body.mimetype() if media_body else 'application/octet-stream'), body.get('appProperties'))
+        with self._lock:
+            return self._metadata(self._files[file_id])
+
+    def _update(self, file_id, body, media_body):
+        with self._lock:
+            file = self._file(file_id)
+            if 'name' in body:
+                file['name'] = body['name']
+            if 'trashed' in body:
+                file['trashed'] = body['trashed']
+        content = self._read_media(media_body) if media_body is not None else None
+        with self._lock:
+            if content is not None:
+                file.pop('path', None)
+                file.pop('content', None)
+                path = self._store(file_id, content)
+                file['path' if path else 'content'] = path or content
+            self._touch(file)
+            return self._metadata(file)
+
+    def _list_changes(self, page_token, page_size):
+        start = int(page_token)
+        with self._lock:
+            end = min(start + page_size, len(self._changes))
+            changes = [{'fileId': file_id, 'removed': file_id not in self._files, 'file': self._metadata(self._files[file_id]) if file_id in self._files else None} for file_id in self._changes[start:end]]
+            response = {'changes': changes}
+            if end < len(self._changes):
+                response['nextPageToken'] = str(end)
+            else:
+                response['newStartPageToken'] = str(end)
+        return response
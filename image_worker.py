@@ -0,0 +1,112 @@
+import io
+import os
+import sys
+import atexit
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageOps
+
+# Bildbehandling i arbetsprocesser. Avkodning och kodning är CPU-bundet, så pdf_motor kör det i
+# en processpool i stället för i trådar. Modulen importerar varken appen eller Drive-klienten,
+# så att arbetsprocesserna bara laddar det de behöver.
+
+THUMBNAIL_WIDTH = 200
+THUMBNAIL_QUALITY = 80
+ALBUM_PAGE_SIZE_MM = (210, 297)  # A4
+IMAGE_PROCESS_WORKERS = os.cpu_count() or 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def render_pdf_page_as_image(pdf_bytes, page_number=0, width=THUMBNAIL_WIDTH):
+    """Renderar en PDF-sida med PyMuPDF till PNG-bytes med ungefär den angivna bredden."""
+    with fitz.open(stream=pdf_bytes, filetype='pdf') as doc:
+        page = doc[page_number]
+        zoom = width / page.rect.width if page.rect.width else 1
+        return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).tobytes('png')
+
+
+def make_thumbnail(image_bytes, width=THUMBNAIL_WIDTH, quality=THUMBNAIL_QUALITY):
+    """Skalar ner en bild med bibehållna proportioner och kodar den som JPEG."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft('RGB', (width, width * 4))  # låter JPEG-avkodaren hoppa över full upplösning
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail((width, width * 4))
+        out = io.BytesIO()
+        image.save(out, format='JPEG', quality=quality, optimize=True)
+        return out.getvalue()
+
+
+def _encode_album_jpeg(image, dpi, quality):
+    # Bilden skalas så att den inte har fler pixlar än sidan kan visa vid vald upplösning
+    max_px = round(max(ALBUM_PAGE_SIZE_MM) / 25.4 * dpi)
+    image = image.convert('RGB')
+    image.thumbnail((max_px, max_px))
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=quality, optimize=True)
+    return out.getvalue()
+
+
+def prepare_album_image(image_bytes, dpi, quality):
+    """Avkodar, roterar enligt EXIF, skalar ner och komprimerar om en bild till JPEG."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        max_px = round(max(ALBUM_PAGE_SIZE_MM) / 25.4 * dpi)
+        image.draft('RGB', (max_px, max_px))
+        return _encode_album_jpeg(ImageOps.exif_transpose(image), dpi, quality)
+
+
+def prepare_image_file(source_path, purpose, render, dpi, quality, width):
+    """Körs i en arbetsprocess. Källan läses från fil och resultaten skrivs som JPEG-filer
+    bredvid den, så att bara sökvägar skickas mellan processerna."""
+    source = Path(source_path)
+    data = source.read_bytes()
+    if purpose == 'thumbnail':
+        images = [make_thumbnail(render_pdf_page_as_image(data, width=width) if render == 'pdf' else data, width, quality)]
+    elif render == 'pdf':
+        images = []
+        with fitz.open(stream=data, filetype='pdf') as doc:
+            for page in doc:
+                pixmap = page.get_pixmap(dpi=dpi)
+                images.append(_encode_album_jpeg(Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples), dpi, quality))
+    else:
+        images = [prepare_album_image(data, dpi, quality)]
+    paths = []
+    for n, image in enumerate(images):
+        target = source.with_name(f"{source.name}.{n}.jpg")
+        target.write_bytes(image)
+        paths.append(str(target))
+    return paths
+
+
+def _get_pool():
+    # Anropas med låset taget. Processerna startas med spawn: att forka en process med
+    # många trådar (Streamlit, jobb, nedladdningspoolen) kan låsa sig i barnet.
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(_pool.shutdown, wait=False, cancel_futures=True)
+    return _pool
+
+
+def submit(fn, *args):
+    """Lägger fn(*args) i processpoolen och returnerar en Future.
+
+    En ny arbetsprocess importerar förälderns __main__, och under Streamlit är det appskriptet,
+    så varje process skulle köra om hela appen. Processerna startas i submit(), så under anropet
+    pekar __main__ på den här modulen i stället.
+    """
+    with _pool_lock:
+        pool = _get_pool()
+        main = sys.modules['__main__']
+        this = sys.modules[__name__]
+        sys.modules['__main__'] = this
+        try:
+            return pool.submit(fn, *args)
+        finally:
+            # Streamlit kan ha installerat ett nytt __main__ under tiden; det ska i så fall stå kvar
+            if sys.modules['__main__'] is this: sys.modules['__main__'] = main
@@ -0,0 +1,111 @@
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import drive_metrics
+
+# Bakgrundsjobb för långa Drive-operationer (dela upp, läsa in, skapa album, arkivera).
+# Jobben körs i en trådpool som lever utanför Streamlits skriptkörningar, så de fortsätter
+# även när en omkörning avbryter skriptet, och gränssnittet frågar efter status.
+
+MAX_JOB_WORKERS = 4
+FINISHED_JOB_TTL = 3600  # sekunder som ett avslutat jobb sparas innan det rensas bort
+
+
+class Job:
+    def __init__(self, owner, kind, context, session_id=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.session_id = session_id
+        self.kind = kind
+        self.context = context
+        self.state = 'queued'
+        self.done = 0
+        self.total = None
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def report(self, done, total=None, partial=None):
+        """Progress-callback som skickas till jobbfunktionen; anropas från jobbtråden."""
+        self.done, self.total = done, total
+        if partial is not None:
+            self.partial = partial
+
+    def snapshot(self):
+        return {
+            'id': self.id, 'owner': self.owner, 'session_id': self.session_id, 'kind': self.kind, 'context': self.context,
+            'state': self.state, 'done': self.done, 'total': self.total, 'partial': self.partial,
+            'result': self.result, 'error': self.error,
+        }
+
+
+class JobRunner:
+    """Trådpool med ett pollbart status-API. En instans delas av alla sessioner i appen."""
+
+    def __init__(self, max_workers=MAX_JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jobb')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, owner, kind, fn, *args, context=None, session_id=None, **kwargs):
+        """Startar fn(*args, progress=..., **kwargs) i bakgrunden och returnerar jobbets ID.
+
+        Ett jobb med samma ägare, session, typ och context som redan körs startas inte igen. session_id
+        anger vilken session som ska ta hand om resultatet; andra sessioner med samma ägare
+        ser bara jobbets förlopp.
+        """
+        context = context or {}
+        with self._lock:
+            self._prune()
+            for job in self._jobs.values():
+                if job.owner == owner and job.session_id == session_id and job.kind == kind and job.context == context and job.state in ('queued', 'running'):
+                    return job.id
+            job = Job(owner, kind, context, session_id)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.snapshot() if job else None
+
+    def jobs_for(self, owner):
+        with self._lock:
+            return [job.snapshot() for job in sorted(self._jobs.values(), key=lambda job: job.created) if job.owner == owner]
+
+    def is_active(self, owner, kind, context=None):
+        return any(job['kind'] == kind and job['context'] == (context or {}) and job['state'] in ('queued', 'running') for job in self.jobs_for(owner))
+
+    def forget(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _run(self, job, fn, args, kwargs):
+        job.state = 'running'
+        try:
+            # Jobbets Drive-anrop mäts som en egen åtgärd med jobbets typ som namn
+            with drive_metrics.measure(job.kind, job.owner):
+                result = fn(*args, progress=job.report, **kwargs)
+            # Motorns funktioner rapporterar fel som {'error': ...} i stället för undantag
+            if isinstance(result, dict) and 'error' in result:
+                job.error = result['error']
+                job.state = 'error'
+            else:
+                job.result = result
+                job.state = 'done'
+        except Exception as e:
+            job.error = f"Oväntat fel i bakgrundsjobbet: {e}"
+            job.state = 'error'
+        finally:
+            job.finished = time.time()
+
+    def _prune(self):
+        # Anropas med låset taget; avslutade jobb som ingen hämtat rensas efter en tid
+        now = time.time()
+        for job_id in [job.id for job in self._jobs.values() if job.finished and now - job.finished > FINISHED_JOB_TTL]:
+            del self._jobs[job_id]
@@ -1,164 +1,1174 @@
 import os
 from pathlib import Path
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
+from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload, MediaUpload
 import io
 import json
+import time
+import hashlib
+import gc
+import sqlite3
+import tempfile
+import threading
+import zipfile
+import shutil
+from concurrent.futures import wait, FIRST_COMPLETED
+from collections import deque
 from pypdf import PdfReader, PdfWriter
-import fitz  # PyMuPDF
+from fpdf import FPDF
 from PIL import Image
 
+import drive_client
+import drive_metrics
+import image_worker
+from image_worker import THUMBNAIL_WIDTH, THUMBNAIL_QUALITY, ALBUM_PAGE_SIZE_MM, IMAGE_PROCESS_WORKERS, render_pdf_page_as_image, make_thumbnail, prepare_album_image
+
 # Konfiguration
 PROJECT_FILE_NAME = '.storyproject.json'
 SUPPORTED_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
 SUPPORTED_TEXT_EXTENSIONS = ('.txt',)
 SUPPORTED_PDF_EXTENSIONS = ('.pdf',)
 SUPPORTED_EXTENSIONS = SUPPORTED_IMAGE_EXTENSIONS + SUPPORTED_TEXT_EXTENSIONS + SUPPORTED_PDF_EXTENSIONS
+MAX_DOWNLOAD_WORKERS = 8  # högsta antal samtidiga nedladdningar per operation i den delade poolen
+LIST_PAGE_SIZE = 1000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_LISTINGS = 500
+CACHE_EVICT_TARGET = 0.9  # andel av max_bytes som rensningen går ned till, så att den inte körs vid varje tillägg
+SYNC_MAX_RETRIES = 1  # sync() körs i varje omkörning och får inte blockera sidan under ett avbrott
+INVALID_TOKEN_STATUSES = (400, 404, 410)
+LISTING_MAX_AGE = 3600  # sekunder; thumbnailLink i en cachad listning slutar gälla efter några timmar
+FILE_FIELDS = 'id, name, mimeType, thumbnailLink, md5Checksum, modifiedTime'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+FOLDER_SEARCH_LIMIT = 20
+PREFETCH_FOLDER_COUNT = 8  # antal undermappar vars filistningar hämtas i förväg
+MAX_UPLOAD_WORKERS = 4
+SIMPLE_UPLOAD_MAX_BYTES = 5 * 1024 * 1024  # mindre filer laddas upp i ett enda multipart-anrop
+SPLIT_SOURCE_PROPERTY = 'splitSourceId'
+SPLIT_CHECKSUM_PROPERTY = 'splitSourceChecksum'
+SPLIT_PAGE_PROPERTY = 'splitPage'
+ORDER_SAVE_DELAY = 2.0  # sekunder utan ändringar innan ordningen skrivs till Drive
+THUMBNAIL_CACHE_MAX_BYTES = 200 * 1024 * 1024
+ALBUM_IMAGE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+ALBUM_DEFAULT_SETTINGS = {'quality': 85, 'dpi': 150, 'max_mb': 20.0, 'margin_mm': 0.0}
+ALBUM_PREFETCH_ITEMS = min(MAX_DOWNLOAD_WORKERS, max(4, IMAGE_PROCESS_WORKERS))  # håller bildprocesserna sysselsatta
+ALBUM_TEXT_MARGIN_MM = 20
+ALBUM_TEXT_FONT_SIZE = 12
+ALBUM_TEXT_LINE_MM = 6
+PDF_PAGE_OVERHEAD_BYTES = 1024  # ungefärlig kostnad för sidobjekt, xref och bildreferens
+ARCHIVE_CHUNK_BYTES = 8 * 1024 * 1024  # uppladdningsbitar måste vara en multipel av 256 KiB
+ARCHIVE_BUFFER_BYTES = 4 * ARCHIVE_CHUNK_BYTES  # mest så här mycket av arkivet hålls i minnet
+ARCHIVE_SPOOL_BYTES = 8 * 1024 * 1024  # större nedladdade filer mellanlagras på disk
+ARCHIVE_PREFETCH_FILES = MAX_DOWNLOAD_WORKERS
+ARCHIVE_STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.pdf', '.zip')  # redan komprimerade
+ARCHIVE_FILE_FIELDS = 'id, name, mimeType, md5Checksum, modifiedTime, size'
+
+# --- Hjälpfunktioner för överföringar ---
+
+def download_file_bytes(service, file_id):
+    return drive_client.execute(service, service.files().get_media(fileId=file_id))
+
+def download_to_file(service, file_id, fh):
+    """Laddar ner en fil i bitar direkt till fh, utan att hålla hela filen i minnet."""
+    client = drive_client.client_for(service)
+    request = service.files().get_media(fileId=file_id)
+    http = client.http()
+    if http is not None: request.http = http
+    downloader = MediaIoBaseDownload(fh, request)
+    done = False
+    while not done:
+        # En misslyckad bit hämtas om utan att de redan skrivna byten påverkas
+        status, done = client.call(lambda http: downloader.next_chunk(), method='files.get_media', size=lambda result, start=fh.tell(): fh.tell() - start)
+    fh.seek(0)
+    return fh
+
+def upload_bytes(service, folder_id, filename, data, mimetype, fields='id', app_properties=None):
+    """Laddar upp data som en ny fil; små filer som multipart, stora som återupptagbar uppladdning."""
+    media_body = MediaIoBaseUpload(io.BytesIO(data), mimetype=mimetype, resumable=len(data) > SIMPLE_UPLOAD_MAX_BYTES)
+    file_metadata = {'name': filename, 'parents': [folder_id]}
+    if app_properties: file_metadata['appProperties'] = app_properties
+    return drive_client.execute(service, service.files().create(body=file_metadata, media_body=media_body, supportsAllDrives=True, fields=fields))
+
+# --- Cache för mapplistningar och filinnehåll ---
+
+class DriveCache:
+    """SQLite-baserad cache per användare för mapplistningar och filinnehåll.
+
+    Innehåll nycklas på fil-ID plus md5Checksum/modifiedTime och listningar på mapp-ID.
+    Listningar ogiltigförklaras via Drives ändringslogg (changes().list) i sync().
+    """
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES, max_listings=CACHE_MAX_LISTINGS):
+        self.max_bytes = max_bytes
+        self.max_listings = max_listings
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS listings (folder_id TEXT, kind TEXT, data TEXT, created REAL, last_used REAL, PRIMARY KEY (folder_id, kind));
+                CREATE TABLE IF NOT EXISTS listing_members (file_id TEXT, folder_id TEXT, PRIMARY KEY (file_id, folder_id));
+                CREATE TABLE IF NOT EXISTS contents (file_id TEXT PRIMARY KEY, version TEXT, data BLOB, size INTEGER, last_used REAL);
+                CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+            """)
+
+    def sync(self, service):
+        """Hämtar ändringar sedan förra anropet och ogiltigförklarar berörda listningar."""
+        try:
+            token = self._get_state('changes_token')
+            if token is None:
+                # Utan token vet vi inte vad som ändrats, så allt cachat kasseras
+                self.clear()
+                response = drive_client.execute(service, service.changes().getStartPageToken(supportsAllDrives=True), max_retries=SYNC_MAX_RETRIES)
+                self._set_state('changes_token', response['startPageToken'])
+                return {'success': True}
+            while token:
+                response = drive_client.execute(service, service.changes().list(pageToken=token, spaces='drive', includeItemsFromAllDrives=True, supportsAllDrives=True, pageSize=1000, fields='nextPageToken, newStartPageToken, changes(fileId, removed, file(parents, mimeType))'), max_retries=SYNC_MAX_RETRIES)
+                for change in response.get('changes', []):
+                    file = change.get('file') or {}
+                    self.invalidate_file(change.get('fileId'), file.get('parents', []), is_folder=file.get('mimeType') == FOLDER_MIME_TYPE)
+                if 'newStartPageToken' in response:
+                    self._set_state('changes_token', response['newStartPageToken'])
+                    break
+                token = response.get('nextPageToken')
+            return {'success': True}
+        except (HttpError, *drive_client.TRANSIENT_ERRORS) as e:
+            # Bara en ogiltig token gör att cachen börjar om; vid avbrott och kvotfel behålls den,
+            # så att ändringarna hämtas vid nästa körning
+            if isinstance(e, HttpError) and e.resp.status in INVALID_TOKEN_STATUSES:
+                self._set_state('changes_token', None)
+            return {'error': f"Kunde inte hämta ändringar från Drive: {drive_client.error_message(e)}"}
+
+    def has_listing(self, folder_id, kind):
+        """Som get_listing, men utan att läsa in datat; för att se om en listning i minnet fortfarande gäller."""
+        with self._lock:
+            row = self._conn.execute("SELECT created FROM listings WHERE folder_id = ? AND kind = ?", (folder_id, kind)).fetchone()
+        return row is not None and time.time() - row[0] <= LISTING_MAX_AGE
+
+    def get_listing(self, folder_id, kind):
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT data, created FROM listings WHERE folder_id = ? AND kind = ?", (folder_id, kind)).fetchone()
+            if row is None or time.time() - row[1] > LISTING_MAX_AGE:
+                return None
+            self._conn.execute("UPDATE listings SET last_used = ? WHERE folder_id = ? AND kind = ?", (time.time(), folder_id, kind))
+        return json.loads(row[0])
+
+    def put_listing(self, folder_id, kind, items):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)", (folder_id, kind, json.dumps(items), now, now))
+            self._conn.executemany("INSERT OR IGNORE INTO listing_members VALUES (?, ?)", [(item['id'], folder_id) for item in items])
+            self._conn.execute("""DELETE FROM listings WHERE rowid IN (
+                SELECT rowid FROM listings ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (self.max_listings,))
+            self._conn.execute("DELETE FROM listing_members WHERE folder_id NOT IN (SELECT folder_id FROM listings)")
+
+    def get_content(self, file_id, version):
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT data FROM contents WHERE file_id = ? AND version = ?", (file_id, version)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE contents SET last_used = ? WHERE file_id = ?", (time.time(), file_id))
+        return bytes(row[0])
+
+    def put_content(self, file_id, version, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock, self._conn:
+            self._delete_content(file_id)
+            self._conn.execute("INSERT INTO contents VALUES (?, ?, ?, ?, ?)", (file_id, version, data, len(data), time.time()))
+            total = self._add_content_bytes(len(data))
+            if total <= self.max_bytes:
+                return
+            # Minst nyligen använda poster kastas tills totalstorleken ryms med marginal
+            for old_id, in self._conn.execute("SELECT file_id FROM contents ORDER BY last_used ASC").fetchall():
+                if total <= self.max_bytes * CACHE_EVICT_TARGET:
+                    break
+                total -= self._delete_content(old_id)
+
+    def _add_content_bytes(self, delta):
+        # Anropas med låset taget. Totalen ligger i databasen, eftersom flera sessioner kan ha samma fil öppen
+        row = self._conn.execute("SELECT value FROM state WHERE key = 'content_bytes'").fetchone()
+        total = int(row[0]) if row else self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM contents").fetchone()[0] - delta
+        total += delta
+        self._conn.execute("INSERT OR REPLACE INTO state VALUES ('content_bytes', ?)", (str(total),))
+        return total
+
+    def _delete_content(self, file_id):
+        # Anropas med låset taget; returnerar antal frigjorda byte
+        row = self._conn.execute("SELECT size FROM contents WHERE file_id = ?", (file_id,)).fetchone()
+        if row is None:
+            return 0
+        self._conn.execute("DELETE FROM contents WHERE file_id = ?", (file_id,))
+        self._add_content_bytes(-row[0])
+        return row[0]
+
+    def invalidate_folder(self, folder_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM listings WHERE folder_id = ?", (folder_id,))
+            self._conn.execute("DELETE FROM listing_members WHERE folder_id = ?", (folder_id,))
+
+    def invalidate_file(self, file_id, parents=(), is_folder=False):
+        with self._lock, self._conn:
+            folders = {row[0] for row in self._conn.execute("SELECT folder_id FROM listing_members WHERE file_id = ?", (file_id,))}
+            # En ändrad mapp påverkar även sin egen listning
+            folders.update(parents)
+            folders.add(file_id)
+            if is_folder:
+                # En ny eller flyttad mapp ändrar de mappträd där någon av dess föräldrar finns med
+                for parent in parents:
+                    folders.update(row[0] for row in self._conn.execute(
+                        "SELECT m.folder_id FROM listing_members m JOIN listings l ON l.folder_id = m.folder_id AND l.kind = 'tree' WHERE m.file_id = ?", (parent,)))
+            for folder_id in folders:
+                self._conn.execute("DELETE FROM listings WHERE folder_id = ?", (folder_id,))
+                self._conn.execute("DELETE FROM listing_members WHERE folder_id = ?", (folder_id,))
+            self._delete_content(file_id)
+
+    def clear(self):
+        with self._lock, self._conn:
+            for table in ('listings', 'listing_members', 'contents'):
+                self._conn.execute(f"DELETE FROM {table}")
+            self._conn.execute("INSERT OR REPLACE INTO state VALUES ('content_bytes', '0')")
+
+    def _get_state(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+
+def _file_version(item):
+    return item.get('md5Checksum') or item.get('modifiedTime')
+
+def download_file_bytes_cached(service, file_id, version=None, cache=None):
+    if cache is None or version is None:
+        return download_file_bytes(service, file_id)
+    data = cache.get_content(file_id, version)
+    if data is None:
+        data = download_file_bytes(service, file_id)
+        cache.put_content(file_id, version, data)
+    return data
 
 # --- Google Drive API-funktioner ---
 
+def _bounded_map(fn, items, window=MAX_DOWNLOAD_WORKERS):
+    """Kör fn(item) i den delade nedladdningspoolen med högst window pågående anrop.
+
+    Ger resultaten i samma ordning som items. Poolen delas av alla sessioner, så en stor
+    operation får inte köa alla sina anrop på en gång och tränga undan andras.
+    """
+    executor = drive_client.download_pool()
+    items = iter(items)
+    pending = deque()
+    try:
+        while True:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                return
+            yield pending.popleft().result()
+    finally:
+        for future in pending: future.cancel()
+
 def get_available_drives(service):
     drives = [{'id': 'root', 'name': 'Min enhet'}]
     try:
-        response = service.drives().list().execute()
+        response = drive_client.execute(service, service.drives().list())
         drives.extend(response.get('drives', []))
         return drives
     except HttpError as e:
-        return {'error': f"Kunde inte hämta lista på enheter: {e}"}
+        return {'error': f"Kunde inte hämta lista på enheter: {drive_client.error_message(e)}"}
+
+def iter_file_pages(service, query, fields, page_size=LIST_PAGE_SIZE, **list_kwargs):
+    """Listar filer sida för sida och följer nextPageToken tills listningen är slut."""
+    page_token = None
+    while True:
+        response = drive_client.execute(service, service.files().list(q=query, supportsAllDrives=True, includeItemsFromAllDrives=True, pageSize=page_size, pageToken=page_token, fields=f"nextPageToken, files({fields})", **list_kwargs))
+        yield response.get('files', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+def list_folders(service, folder_id='root', cache=None):
+    try:
+        folders = cache.get_listing(folder_id, 'folders') if cache else None
+        if folders is None:
+            query = f"'{folder_id}' in parents and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false"
+            folders = [folder for page in iter_file_pages(service, query, 'id, name', spaces='drive') for folder in page]
+            if cache: cache.put_listing(folder_id, 'folders', folders)
+        return folders
+    except HttpError as e:
+        return {'error': f"Kunde inte hämta mappar: {drive_client.error_message(e)}"}
+
+class FolderTree:
+    """En enhets mappträd i minnet: undermappar per mapp och föräldrar per mapp.
+
+    Trädet byggs från en enda sökning efter alla mappar på enheten, så att navigering,
+    sökvägar och namnsökning sedan besvaras utan anrop till Drive.
+    """
+
+    def __init__(self, drive_id, folders):
+        self.drive_id = drive_id
+        self.loaded_at = time.time()
+        self.root_id = next((folder['id'] for folder in folders if folder.get('root')), drive_id)
+        self._folders = {folder['id']: folder for folder in folders}
+        self._children = {}
+        for folder in folders:
+            for parent in folder.get('parents', []):
+                self._children.setdefault(parent, []).append(folder)
+        for children in self._children.values():
+            children.sort(key=lambda folder: folder.get('name', '').lower())
+
+    def _resolve(self, folder_id):
+        return self.root_id if folder_id in ('root', self.drive_id) else folder_id
+
+    def __contains__(self, folder_id):
+        return self._resolve(folder_id) in self._folders
+
+    def __len__(self):
+        return len(self._folders) - (1 if self.root_id in self._folders else 0)
+
+    def children(self, folder_id):
+        return self._children.get(self._resolve(folder_id), [])
+
+    def path(self, folder_id):
+        """Mapparna mellan enhetens rot och folder_id som [(id, namn), ...], eller None om mappen inte nås från roten."""
+        path, seen = [], set()
+        current = self._folders.get(self._resolve(folder_id))
+        while current is not None and current['id'] not in seen:
+            seen.add(current['id'])
+            parent_id = next((parent for parent in current.get('parents', []) if parent in self._folders or parent == self.root_id), None)
+            if parent_id is None:
+                return None
+            if parent_id == self.root_id:
+                return list(reversed(path))
+            current = self._folders[parent_id]
+            path.append((current['id'], current.get('name', '')))
+        return None
+
+    def search(self, text, limit=FOLDER_SEARCH_LIMIT):
+        """Mappar vars namn innehåller text, med sökväg; bara mappar som nås från enhetens rot."""
+        text = text.strip().lower()
+        results = []
+        if not text:
+            return results
+        for folder in sorted(self._folders.values(), key=lambda folder: folder.get('name', '').lower()):
+            if folder.get('root') or text not in folder.get('name', '').lower():
+                continue
+            path = self.path(folder['id'])
+            if path is not None:
+                results.append({'id': folder['id'], 'name': folder.get('name', ''), 'path': path})
+                if len(results) >= limit:
+                    break
+        return results
+
+def load_folder_tree(service, drive_id='root', cache=None, current=None):
+    """Returnerar enhetens FolderTree.
+
+    current återanvänds så länge cachens listning gäller (eller, utan cache, tills den blivit
+    för gammal); annars läses trädet från cachen eller hämtas i en enda sökning. Ändrade mappar
+    ogiltigförklarar den cachade listningen i DriveCache.sync().
+    """
+    # Trädet nycklas skilt från rotmappens egna listningar, som ogiltigförklaras vid varje filändring i roten
+    tree_key = f"tree:{drive_id}"
+    try:
+        if current is not None and current.drive_id == drive_id:
+            still_valid = cache.has_listing(tree_key, 'tree') if cache else time.time() - current.loaded_at <= LISTING_MAX_AGE
+            if still_valid: return current
+        folders = cache.get_listing(tree_key, 'tree') if cache else None
+        if folders is None:
+            # Rotmappens riktiga ID behövs, eftersom mapparnas parents aldrig innehåller aliaset 'root'
+            root = drive_client.execute(service, service.files().get(fileId=drive_id, fields='id, name', supportsAllDrives=True))
+            query = f"mimeType = '{FOLDER_MIME_TYPE}' and trashed = false"
+            list_kwargs = {'corpora': 'user'} if drive_id == 'root' else {'corpora': 'drive', 'driveId': drive_id}
+            folders = [{'id': root['id'], 'name': root.get('name', ''), 'parents': [], 'root': True}]
+            folders += [folder for page in iter_file_pages(service, query, 'id, name, parents', **list_kwargs) for folder in page]
+            if cache: cache.put_listing(tree_key, 'tree', folders)
+        return FolderTree(drive_id, folders)
+    except HttpError as e:
+        return {'error': f"Kunde inte hämta mappträdet: {drive_client.error_message(e)}"}
+
+_prefetch_lock = threading.Lock()
+_prefetching = set()
+
+def _iter_folder_item_pages(service, folder_id, page_size=LIST_PAGE_SIZE):
+    query = f"'{folder_id}' in parents and trashed = false"
+    return iter_file_pages(service, query, FILE_FIELDS, page_size=page_size, corpora="allDrives")
+
+def prefetch_folder_listings(service, folder_ids, cache, owner=None):
+    """Hämtar i förväg filistningarna för mappar som användaren troligen öppnar härnäst.
+
+    Listningarna hamnar i DriveCache, så att "Läs in denna mapp" för en av dem bara behöver
+    hämta textinnehållet. Mappar som redan är cachade eller hämtas hoppas över.
+    """
+    with _prefetch_lock:
+        todo = [folder_id for folder_id in dict.fromkeys(folder_ids) if (id(cache), folder_id) not in _prefetching and not cache.has_listing(folder_id, 'files')]
+        _prefetching.update((id(cache), folder_id) for folder_id in todo)
+    if not todo: return
+    with drive_metrics.measure('prefetch', owner):
+        for folder_id in todo:
+            try:
+                cache.put_listing(folder_id, 'files', [item for page in _iter_folder_item_pages(service, folder_id) for item in page])
+            except HttpError as e:
+                print(f"Kunde inte förhämta mappen {folder_id}: {drive_client.error_message(e)}")
+            finally:
+                with _prefetch_lock:
+                    _prefetching.discard((id(cache), folder_id))
 
-def list_folders(service, folder_id='root'):
+def _read_project_data(service, project_file_id, version=None, cache=None):
     try:
-        query = f"'{folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-        results = service.files().list(q=query, supportsAllDrives=True, includeItemsFromAllDrives=True, spaces='drive', fields='files(id, name)').execute()
-        return results.get('files', [])
+        return json.loads(download_file_bytes_cached(service, project_file_id, version, cache).decode('utf-8'))
     except HttpError as e:
-        return {'error': f"Kunde inte hämta mappar: {e}"}
+        print(f"Kunde inte ladda projektfil: {e}")
+    return None
 
 def load_story_order(service, folder_id):
     try:
         query = f"'{folder_id}' in parents and name = '{PROJECT_FILE_NAME}' and trashed = false"
-        response = service.files().list(q=query, corpora="allDrives", includeItemsFromAllDrives=True, supportsAllDrives=True, fields="files(id)").execute()
+        response = drive_client.execute(service, service.files().list(q=query, corpora="allDrives", includeItemsFromAllDrives=True, supportsAllDrives=True, fields="files(id)"))
         files = response.get('files', [])
         if files:
-            request = service.files().get_media(fileId=files[0]['id'])
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            project_data = json.loads(fh.getvalue().decode('utf-8'))
-            return project_data.get('order', [])
+            project_data = _read_project_data(service, files[0]['id'])
+            return project_data.get('order', []) if project_data else None
     except HttpError as e:
         print(f"Kunde inte ladda projektfil: {e}")
     return None
 
-def save_story_order(service, folder_id, story_items):
+def save_story_order(service, folder_id, story_items, cache=None, project_file_id=None, expected_version=None):
+    """Skriver ordningen till projektfilen.
+
+    Med project_file_id slipper vi leta upp filen. Med expected_version (md5Checksum, eller ''
+    om ingen projektfil fanns) avbryts skrivningen om någon annan har ändrat filen sedan dess.
+    """
     order_to_save = [item['filename'] for item in story_items]
-    content = json.dumps({'order': order_to_save}, indent=2).encode('utf-8')
-    fh = io.BytesIO(content)
-    media_body = MediaIoBaseUpload(fh, mimetype='application/json', resumable=True)
+    ids_to_save = [item['id'] for item in story_items]
+    content = json.dumps({'order': order_to_save, 'ids': ids_to_save}, indent=2).encode('utf-8')
     try:
-        query = f"'{folder_id}' in parents and name = '{PROJECT_FILE_NAME}' and trashed = false"
-        response = service.files().list(q=query, corpora="allDrives", includeItemsFromAllDrives=True, supportsAllDrives=True, fields="files(id)").execute()
-        existing_files = response.get('files', [])
-        if existing_files:
-            service.files().update(fileId=existing_files[0]['id'], media_body=media_body, supportsAllDrives=True).execute()
+        if project_file_id is None:
+            query = f"'{folder_id}' in parents and name = '{PROJECT_FILE_NAME}' and trashed = false"
+            response = drive_client.execute(service, service.files().list(q=query, corpora="allDrives", includeItemsFromAllDrives=True, supportsAllDrives=True, fields="files(id)"))
+            existing_files = response.get('files', [])
+            if existing_files and expected_version == '':
+                return {'error': "Någon annan har skapat en projektfil i mappen. Läs in mappen igen.", 'conflict': True}
+            project_file_id = existing_files[0]['id'] if existing_files else None
+        elif expected_version is not None:
+            current = drive_client.execute(service, service.files().get(fileId=project_file_id, fields='md5Checksum, modifiedTime', supportsAllDrives=True))
+            if _file_version(current) != expected_version:
+                return {'error': "Projektfilen har ändrats av någon annan. Läs in mappen igen.", 'conflict': True}
+
+        if project_file_id:
+            media_body = MediaIoBaseUpload(io.BytesIO(content), mimetype='application/json')
+            project_file = drive_client.execute(service, service.files().update(fileId=project_file_id, media_body=media_body, supportsAllDrives=True, fields='id, md5Checksum, modifiedTime'))
         else:
-            file_metadata = {'name': PROJECT_FILE_NAME, 'parents': [folder_id]}
-            service.files().create(body=file_metadata, media_body=media_body, supportsAllDrives=True, fields='id').execute()
-        return {'success': True}
+            project_file = upload_bytes(service, folder_id, PROJECT_FILE_NAME, content, 'application/json', fields='id, md5Checksum, modifiedTime')
+        if cache: cache.invalidate_folder(folder_id)
+        return {'success': True, 'project_file': project_file}
     except HttpError as e:
-        return {'error': f"Kunde inte spara projektfilen: {e}"}
-
-def get_content_units_from_folder(service, folder_id):
-    try:
-        query = f"'{folder_id}' in parents and trashed = false"
-        results = service.files().list(q=query, corpora="allDrives", includeItemsFromAllDrives=True, supportsAllDrives=True, pageSize=1000, fields="files(id, name, mimeType, thumbnailLink)").execute()
-        items = results.get('files', [])
-        
-        unit_map = {item.get('name'): item for item in items if item.get('name') != PROJECT_FILE_NAME}
-        
-        saved_order = load_story_order(service, folder_id)
-        final_google_items = []
-        if saved_order:
-            ordered_map = {filename: unit_map.pop(filename) for filename in saved_order if filename in unit_map}
-            final_google_items.extend(list(ordered_map.values()))
-        
-        remaining_items = sorted(list(unit_map.values()), key=lambda x: x.get('name', '').lower())
-        final_google_items.extend(remaining_items)
-
-        story_units = []
-        for item in final_google_items:
-            filename = item.get('name')
-            ext = os.path.splitext(filename)[1].lower()
-            if ext in SUPPORTED_EXTENSIONS:
-                unit = {'filename': filename, 'id': item.get('id'), 'type': 'unknown', 'thumbnail': item.get('thumbnailLink')}
-                if ext in SUPPORTED_IMAGE_EXTENSIONS: unit['type'] = 'image'
-                elif ext in SUPPORTED_TEXT_EXTENSIONS:
-                    unit['type'] = 'text'
-                    try:
-                        request = service.files().get_media(fileId=item.get('id'))
-                        fh = io.BytesIO()
-                        downloader = MediaIoBaseDownload(fh, request)
-                        done = False
-                        while not done: status, done = downloader.next_chunk()
-                        unit['content'] = fh.getvalue().decode('utf-8')
-                    except Exception as e:
-                        unit['content'] = f"Fel vid läsning av fil: {e}"
-                elif ext in SUPPORTED_PDF_EXTENSIONS: unit['type'] = 'pdf'
-                story_units.append(unit)
-        return {'units': story_units}
-    except HttpError as e: return {'error': f"Kunde inte hämta filer: {e}"}
-
-def upload_new_text_file(service, folder_id, filename, content):
-    try:
-        content_bytes = content.encode('utf-8')
-        fh = io.BytesIO(content_bytes)
-        media_body = MediaIoBaseUpload(fh, mimetype='text/plain', resumable=True)
-        file_metadata = {'name': filename, 'parents': [folder_id]}
-        service.files().create(body=file_metadata, media_body=media_body, supportsAllDrives=True, fields='id').execute()
+        return {'error': f"Kunde inte spara projektfilen: {drive_client.error_message(e)}"}
+
+class StoryOrderWriter:
+    """Slår ihop snabba ändringar av berättelseordningen till en skrivning.
+
+    schedule() startar om en timer vid varje ändring och skrivningen sker först efter
+    en tyst period, eller direkt vid flush(). Projektfilens ID och version hålls i minnet
+    så att varje skrivning blir en versionskontroll plus en uppdatering. Skrivningarna mäts
+    som egna åtgärder ('save_order') för owner, eftersom de sker på timerns tråd.
+    """
+
+    def __init__(self, service, folder_id, project_file=None, cache=None, delay=ORDER_SAVE_DELAY, owner=None):
+        self.service = service
+        self.folder_id = folder_id
+        self.cache = cache
+        self.delay = delay
+        self.owner = owner
+        self.project_file_id = project_file.get('id') if project_file else None
+        self.version = _file_version(project_file) if project_file else ''
+        self.last_result = None
+        self._pending = None
+        self._saved = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def schedule(self, story_items):
+        order = [{'id': item['id'], 'filename': item['filename']} for item in story_items]
+        with self._lock:
+            self._pending = order
+            if self._timer: self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        # _lock skyddar bara _pending och timern, så schedule() väntar aldrig på Drive.
+        # _write_lock gör att en skrivning i taget pågår och att den tar den senaste ordningen.
+        with self._write_lock:
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                order, self._pending = self._pending, None
+            # Inget att skriva om ordningen inte ändrats sedan senaste sparningen
+            if order is None or order == self._saved:
+                return self.last_result or {'success': True}
+            with drive_metrics.measure('save_order', self.owner):
+                result = save_story_order(self.service, self.folder_id, order, cache=self.cache, project_file_id=self.project_file_id, expected_version=self.version)
+            if 'project_file' in result:
+                self.project_file_id = result['project_file'].get('id')
+                self.version = _file_version(result['project_file'])
+                self._saved = order
+            self.last_result = result
+            return result
+
+def _read_text_content(service, file_id, version=None, cache=None):
+    try:
+        return download_file_bytes_cached(service, file_id, version, cache).decode('utf-8')
+    except Exception as e:
+        return f"Fel vid läsning av fil: {e}"
+
+def _to_story_unit(item, text_contents):
+    filename = item.get('name')
+    ext = os.path.splitext(filename)[1].lower()
+    unit = {'filename': filename, 'id': item.get('id'), 'type': 'unknown', 'thumbnail': item.get('thumbnailLink'), 'checksum': _file_version(item)}
+    if ext in SUPPORTED_IMAGE_EXTENSIONS: unit['type'] = 'image'
+    elif ext in SUPPORTED_TEXT_EXTENSIONS:
+        unit['type'] = 'text'
+        unit['content'] = text_contents[item.get('id')]
+    elif ext in SUPPORTED_PDF_EXTENSIONS: unit['type'] = 'pdf'
+    return unit
+
+def iter_content_units_from_folder(service, folder_id, page_size=LIST_PAGE_SIZE, cache=None):
+    """Strömmar mappens innehåll: ger {'units': [...]} per listningssida i Drives ordning,
+    följt av {'order': [...], 'order_ids': [...], 'project_file': {...}} om en projektfil finns."""
+    try:
+        cached_items = cache.get_listing(folder_id, 'files') if cache else None
+        pages = [cached_items] if cached_items is not None else _iter_folder_item_pages(service, folder_id, page_size)
+        listed_items = []
+        executor = drive_client.download_pool()
+        order_future, project_file = None, None
+        for items in pages:
+            if cache and cached_items is None: listed_items.extend(items)
+            # Projektfilen hittas i samma listning, så inget extra list-anrop behövs
+            project_file = project_file or next((item for item in items if item.get('name') == PROJECT_FILE_NAME), None)
+            if project_file and order_future is None:
+                order_future = executor.submit(_read_project_data, service, project_file['id'], _file_version(project_file), cache)
+
+            supported_items = [item for item in items if os.path.splitext(item.get('name', ''))[1].lower() in SUPPORTED_EXTENSIONS]
+            text_items = [item for item in supported_items if os.path.splitext(item.get('name', ''))[1].lower() in SUPPORTED_TEXT_EXTENSIONS]
+            # Textinnehållet för sidan hämtas parallellt, högst MAX_DOWNLOAD_WORKERS filer åt gången
+            contents = _bounded_map(lambda item: _read_text_content(service, item['id'], _file_version(item), cache), text_items)
+            text_contents = {item['id']: content for item, content in zip(text_items, contents)}
+            yield {'units': [_to_story_unit(item, text_contents) for item in supported_items]}
+        if cache and cached_items is None: cache.put_listing(folder_id, 'files', listed_items)
+        if order_future:
+            project_data = order_future.result() or {}
+            yield {'order': project_data.get('order', []), 'order_ids': project_data.get('ids'), 'project_file': project_file}
+    except HttpError as e: yield {'error': f"Kunde inte hämta filer: {drive_client.error_message(e)}"}
+
+def order_story_units(units, saved_order, saved_ids=None):
+    unit_map = {unit['filename']: unit for unit in units}
+    filename_by_id = {unit['id']: unit['filename'] for unit in units}
+    ordered_units = []
+    for position, filename in enumerate(saved_order or []):
+        # ID:t följer filen även om den har bytt namn sedan ordningen sparades
+        if saved_ids and position < len(saved_ids):
+            filename = filename_by_id.get(saved_ids[position], filename)
+        if filename in unit_map:
+            ordered_units.append(unit_map.pop(filename))
+    ordered_units.extend(sorted(unit_map.values(), key=lambda x: x.get('filename', '').lower()))
+    return ordered_units
+
+def get_content_units_from_folder(service, folder_id, cache=None, progress=None):
+    """Läser in mappen som ordnade berättelseobjekt. progress(antal, None, objekt) anropas per listningssida."""
+    units, saved_order, saved_ids, project_file = [], None, None, None
+    for result in iter_content_units_from_folder(service, folder_id, cache=cache):
+        if 'error' in result: return result
+        units.extend(result.get('units', []))
+        saved_order = result.get('order', saved_order)
+        saved_ids = result.get('order_ids', saved_ids)
+        project_file = result.get('project_file', project_file)
+        if progress and 'units' in result: progress(len(units), None, units)
+    return {'units': order_story_units(units, saved_order, saved_ids), 'project_file': project_file}
+
+def upload_new_text_file(service, folder_id, filename, content, cache=None):
+    try:
+        upload_bytes(service, folder_id, filename, content.encode('utf-8'), 'text/plain')
+        if cache: cache.invalidate_folder(folder_id)
         return {'success': True}
     except HttpError as e:
-        return {'error': f"Kunde inte ladda upp textfil: {e}"}
+        return {'error': f"Kunde inte ladda upp textfil: {drive_client.error_message(e)}"}
+
+def _iter_single_page_pdfs(reader, skip_pages=()):
+    """Skapar en-sidiga PDF:er en i taget, så att bara ett fåtal sidor ligger i minnet samtidigt."""
+    for i, page in enumerate(reader.pages):
+        if i + 1 in skip_pages:
+            continue
+        writer = PdfWriter()
+        writer.add_page(page)
+        page_buffer = io.BytesIO()
+        writer.write(page_buffer)
+        yield i + 1, page_buffer.getvalue()
+
+def load_split_manifest(service, folder_id, source_id, source_checksum):
+    """Hittar sidor som redan skapats av en tidigare, avbruten uppdelning av samma källfil.
 
-def split_pdf_and_upload(service, file_id, original_filename, folder_id):
+    Varje uppladdad sida bär källans ID, checksumma och sidnummer som appProperties,
+    så manifestet finns kvar på Drive även om sessionen eller appen startas om.
+    """
+    query = f"'{folder_id}' in parents and appProperties has {{ key='{SPLIT_SOURCE_PROPERTY}' and value='{source_id}' }} and trashed = false"
+    finished_pages = {}
+    for files in iter_file_pages(service, query, 'id, name, mimeType, thumbnailLink, md5Checksum, appProperties', corpora="allDrives"):
+        for file in files:
+            properties = file.get('appProperties', {})
+            if properties.get(SPLIT_CHECKSUM_PROPERTY) == source_checksum:
+                finished_pages.setdefault(int(properties[SPLIT_PAGE_PROPERTY]), file)
+    return finished_pages
+
+def split_pdf_and_upload(service, file_id, original_filename, folder_id, cache=None, progress=None):
     try:
-        request = service.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        fh.seek(0)
-        
-        reader = PdfReader(fh)
-        newly_created_files = []
         base_name = os.path.splitext(original_filename)[0]
-        
-        for i, page in enumerate(reader.pages):
-            writer = PdfWriter()
-            writer.add_page(page)
-            
-            page_buffer = io.BytesIO()
-            writer.write(page_buffer)
-            page_buffer.seek(0)
-            
-            new_filename = f"{base_name}_sida_{i+1:03}.pdf"
-            media_body = MediaIoBaseUpload(page_buffer, mimetype='application/pdf', resumable=True)
-            file_metadata = {'name': new_filename, 'parents': [folder_id]}
-            file = service.files().create(
-                body=file_metadata,
-                media_body=media_body,
-                supportsAllDrives=True,
-                fields='id, name, mimeType, thumbnailLink'
-            ).execute()
-            
-            new_unit = {
-                'filename': file.get('name'), 'id': file.get('id'), 'type': 'pdf',
-                'thumbnail': file.get('thumbnailLink')
-            }
-            newly_created_files.append(new_unit)
-            
-        return {'new_files': newly_created_files}
+        source_checksum = drive_client.execute(service, service.files().get(fileId=file_id, fields='md5Checksum', supportsAllDrives=True)).get('md5Checksum', '')
+        created_files = load_split_manifest(service, folder_id, file_id, source_checksum)
+        resumed_pages = len(created_files)
+        executor = drive_client.upload_pool()
+        with tempfile.TemporaryFile() as fh:
+            reader = PdfReader(download_to_file(service, file_id, fh))
+            page_count = len(reader.pages)
+            futures, in_flight, pages_done = {}, set(), resumed_pages
+            if progress and pages_done: progress(pages_done, page_count)
+
+            for page_number, page_bytes in _iter_single_page_pdfs(reader, skip_pages=created_files):
+                # Begränsa antalet sidor som väntar på uppladdning
+                if len(in_flight) >= 2 * MAX_UPLOAD_WORKERS:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    pages_done += len(finished)
+                    if progress: progress(pages_done, page_count)
+                new_filename = f"{base_name}_sida_{page_number:03}.pdf"
+                app_properties = {SPLIT_SOURCE_PROPERTY: file_id, SPLIT_CHECKSUM_PROPERTY: source_checksum, SPLIT_PAGE_PROPERTY: str(page_number)}
+                future = executor.submit(upload_bytes, service, folder_id, new_filename, page_bytes, 'application/pdf', 'id, name, mimeType, thumbnailLink, md5Checksum', app_properties)
+                futures[page_number] = future
+                in_flight.add(future)
+
+            while in_flight:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                pages_done += len(finished)
+                if progress: progress(pages_done, page_count)
+
+            for page_number, future in futures.items():
+                created_files[page_number] = future.result()
+
+        # Resultatet följer sidordningen oavsett i vilken ordning uppladdningarna blev klara
+        newly_created_files = [{
+            'filename': file.get('name'), 'id': file.get('id'), 'type': 'pdf',
+            'thumbnail': file.get('thumbnailLink'), 'checksum': _file_version(file)
+        } for page_number, file in sorted(created_files.items()) if page_number <= page_count]
+
+        if cache: cache.invalidate_folder(folder_id)
+        return {'new_files': newly_created_files, 'resumed_pages': resumed_pages}
+    except Exception as e:
+        if cache: cache.invalidate_folder(folder_id)
+        return {'error': f"Kunde inte dela upp PDF: {drive_client.error_message(e)}"}
+
+# --- Bildcache och bildförberedelse ---
+
+class ImageCache:
+    """Storleksbegränsad diskcache för färdiga bilder, adresserad via filens checksumma och inställningar."""
+
+    def __init__(self, directory, max_bytes=THUMBNAIL_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = sum(path.stat().st_size for path in self.directory.glob('*.jpg'))
+
+    def _path(self, key):
+        return self.directory / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.jpg"
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # mtime används som "senast använd" vid utrensning
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+        with self._lock:
+            self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Anropas med låset taget; minst nyligen använda bilder tas bort först
+        entries = []
+        for path in self.directory.glob('*.jpg'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        self._total_bytes = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if self._total_bytes <= self.max_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            self._total_bytes -= size
+
+def _image_memo_key(purpose, checksum, dpi, quality, width):
+    return f"{purpose}:{checksum}:{dpi}:{quality}:{width}" if checksum else None
+
+def _memo_get(image_cache, key):
+    count = image_cache.get(f"{key}:count") if image_cache and key else None
+    if count is None:
+        return None
+    images = [image_cache.get(f"{key}:{n}") for n in range(int(count))]
+    return None if any(image is None for image in images) else images
+
+def _memo_put(image_cache, key, images):
+    if not (image_cache and key):
+        return
+    for n, image in enumerate(images):
+        image_cache.put(f"{key}:{n}", image)
+    image_cache.put(f"{key}:count", str(len(images)).encode('ascii'))
+
+def prepare_images(service, file_id, purpose, render, dpi=ALBUM_DEFAULT_SETTINGS['dpi'], quality=ALBUM_DEFAULT_SETTINGS['quality'],
+                   width=THUMBNAIL_WIDTH, checksum=None, image_cache=None, source_bytes=None):
+    """Förbereder en fils bilder i processpoolen och returnerar en lista med JPEG-bytes (en per sida).
+
+    purpose är 'thumbnail' eller 'album' och render är 'image' eller 'pdf'. Resultatet memoiseras
+    på (checksumma, inställningar), så en fil som redan förberetts varken hämtas eller kodas om.
+    """
+    key = _image_memo_key(purpose, checksum, dpi, quality, width)
+    images = _memo_get(image_cache, key)
+    if images is not None:
+        return images
+    with tempfile.TemporaryDirectory(prefix='berattelse_') as scratch:
+        source_path = os.path.join(scratch, 'source')
+        with open(source_path, 'wb') as fh:
+            if source_bytes is not None: fh.write(source_bytes)
+            else: download_to_file(service, file_id, fh)
+        paths = image_worker.submit(image_worker.prepare_image_file, source_path, purpose, render, dpi, quality, width).result()
+        images = [Path(path).read_bytes() for path in paths]
+    _memo_put(image_cache, key, images)
+    return images
+
+# --- Miniatyrbilder ---
+
+def _fetch_thumbnail_link(service, unit):
+    # Drives egen miniatyr är billigast att hämta när den finns. Anropet går via klienten så att
+    # det räknas i drive_metrics och får samma omförsök och pausning vid kvotfel som API-anropen.
+    client = drive_client.client_for(service)
+    if not unit.get('thumbnail') or client.http() is None:
+        return None
+    def fetch(http):
+        response, content = http.request(unit['thumbnail'])
+        if response.status != 200: raise HttpError(response, content, uri=unit['thumbnail'])
+        return content
+    try:
+        return client.call(fetch, method='thumbnail')
+    except Exception:
+        return None
+
+def get_thumbnail(service, unit, image_cache, width=THUMBNAIL_WIDTH):
+    try:
+        key = _image_memo_key('thumbnail', unit.get('checksum'), None, THUMBNAIL_QUALITY, width)
+        images = _memo_get(image_cache, key)
+        if images is None:
+            link_bytes = _fetch_thumbnail_link(service, unit)
+            render = 'pdf' if unit.get('type') == 'pdf' and link_bytes is None else 'image'
+            images = prepare_images(service, unit['id'], 'thumbnail', render, dpi=None, quality=THUMBNAIL_QUALITY, width=width,
+                                    checksum=unit.get('checksum'), image_cache=image_cache, source_bytes=link_bytes)
+        return images[0]
+    except Exception as e:
+        print(f"Kunde inte skapa miniatyr för {unit.get('filename')}: {e}")
+        return None
+
+def get_thumbnails(service, units, image_cache, width=THUMBNAIL_WIDTH):
+    """Returnerar {fil-ID: JPEG-bytes} för bilder och PDF:er; saknade miniatyrer skapas parallellt."""
+    thumbnails, missing = {}, []
+    for unit in units:
+        if unit.get('type') not in ('image', 'pdf'):
+            continue
+        images = _memo_get(image_cache, _image_memo_key('thumbnail', unit.get('checksum'), None, THUMBNAIL_QUALITY, width))
+        thumbnails[unit['id']] = images[0] if images else None
+        if thumbnails[unit['id']] is None: missing.append(unit)
+    results = _bounded_map(lambda unit: get_thumbnail(service, unit, image_cache, width), missing)
+    thumbnails.update({unit['id']: thumbnail for unit, thumbnail in zip(missing, results)})
+    return thumbnails
+
+# --- PDF-album ---
+
+def _prepare_album_item(service, item, settings, image_cache=None):
+    """Hämtar och förbereder ett objekt till albumsidor: ('image', jpeg, bredd, höjd) eller ('text', text)."""
+    if item.get('type') == 'text':
+        return _paginate_album_text(item.get('content', ''), settings['margin_mm'])
+    images = prepare_images(service, item['id'], 'album', 'pdf' if item.get('type') == 'pdf' else 'image',
+                            dpi=settings['dpi'], quality=settings['quality'], width=None,
+                            checksum=item.get('checksum'), image_cache=image_cache)
+    pages = []
+    for jpeg in images:
+        with Image.open(io.BytesIO(jpeg)) as image:  # läser bara JPEG-huvudet
+            pages.append(('image', jpeg, image.width, image.height))
+    return pages
+
+def _iter_prepared_items(service, story_items, settings, image_cache=None, prefetch=ALBUM_PREFETCH_ITEMS):
+    """Ger förberedda sidor objekt för objekt medan de närmaste objekten hämtas i förväg."""
+    executor = drive_client.download_pool()
+    window = deque()
+    items = iter(story_items)
+    for item in items:
+        window.append((item, executor.submit(_prepare_album_item, service, item, settings, image_cache)))
+        if len(window) >= prefetch:
+            break
+    try:
+        while window:
+            item, future = window.popleft()
+            next_item = next(items, None)
+            if next_item is not None:
+                window.append((next_item, executor.submit(_prepare_album_item, service, next_item, settings, image_cache)))
+            yield item, future.result()
+    finally:
+        # Vid avbrott ska poolen inte fortsätta förbereda objekt som ingen väntar på
+        for item, future in window: future.cancel()
+
+def _paginate_album_text(text, margin_mm):
+    """Delar en text i albumsidor, så att långa texter fortsätter på nästa sida i stället för att klippas."""
+    text_margin = max(margin_mm, ALBUM_TEXT_MARGIN_MM)
+    pdf = _new_album_pdf()
+    pdf.add_page(orientation='P')
+    pdf.set_font('Helvetica', size=ALBUM_TEXT_FONT_SIZE)
+    # Standardtypsnitten klarar bara Latin-1, vilket räcker för svenska tecken
+    text = text.encode('latin-1', 'replace').decode('latin-1')
+    lines = pdf.multi_cell(pdf.w - 2 * text_margin, ALBUM_TEXT_LINE_MM, text, dry_run=True, output='LINES')
+    lines_per_page = max(1, int((pdf.h - 2 * text_margin) // ALBUM_TEXT_LINE_MM))
+    return [('text', '\n'.join(lines[start:start + lines_per_page])) for start in range(0, len(lines), lines_per_page)] or [('text', '')]
+
+def _estimate_page_bytes(page):
+    # JPEG-data bäddas in oförändrad (DCTDecode), så storleken är känd innan sidan läggs till
+    if page[0] == 'image':
+        return len(page[1]) + PDF_PAGE_OVERHEAD_BYTES
+    return len(page[1].encode('utf-8')) + PDF_PAGE_OVERHEAD_BYTES
+
+def _new_album_pdf():
+    pdf = FPDF(unit='mm', format=ALBUM_PAGE_SIZE_MM)
+    pdf.set_auto_page_break(False)
+    return pdf
+
+def _add_album_page(pdf, page, margin_mm):
+    if page[0] == 'image':
+        jpeg, width_px, height_px = page[1:]
+        pdf.add_page(orientation='L' if width_px > height_px else 'P')
+        area_w, area_h = pdf.w - 2 * margin_mm, pdf.h - 2 * margin_mm
+        scale = min(area_w / width_px, area_h / height_px)
+        w, h = width_px * scale, height_px * scale
+        pdf.image(io.BytesIO(jpeg), x=(pdf.w - w) / 2, y=(pdf.h - h) / 2, w=w, h=h)
+    else:
+        text_margin = max(margin_mm, ALBUM_TEXT_MARGIN_MM)
+        pdf.add_page(orientation='P')
+        pdf.set_margins(text_margin, text_margin, text_margin)
+        pdf.set_xy(text_margin, text_margin)
+        pdf.set_font('Helvetica', size=ALBUM_TEXT_FONT_SIZE)
+        # Texten är redan radbruten och anpassad till en sida av _paginate_album_text()
+        pdf.multi_cell(0, ALBUM_TEXT_LINE_MM, page[1])
+
+def _write_album_part(pdf, output_dir, base_name, part):
+    filename = f"{base_name}_{part:02}.pdf"
+    path = os.path.join(output_dir, filename)
+    pdf.output(path)
+    return {'filename': filename, 'path': path, 'size': os.path.getsize(path)}
+
+def iter_album_pdfs(service, story_items, settings=None, base_name='album', progress=None, image_cache=None, output_dir=None):
+    """Bygger albumet som en ström och skriver varje färdig, numrerad PDF till output_dir.
+
+    Ger {'filename', 'path', 'size'} per PDF. Varje sidas bytekostnad uppskattas innan den läggs
+    till, och när maxstorleken skulle överskridas skrivs aktuell PDF till disk och nästa påbörjas.
+    Minnet begränsas av förhämtningsfönstret och storleken på en enskild PDF, inte av albumets
+    totala storlek.
+    """
+    settings = {**ALBUM_DEFAULT_SETTINGS, **(settings or {})}
+    output_dir = output_dir or tempfile.mkdtemp(prefix='album_')
+    budget = settings['max_mb'] * 1024 * 1024
+    pdf, used_bytes, part = _new_album_pdf(), 0, 1
+    for done, (item, pages) in enumerate(_iter_prepared_items(service, story_items, settings, image_cache), 1):
+        for page in pages:
+            cost = _estimate_page_bytes(page)
+            if pdf.page_no() > 0 and used_bytes + cost > budget:
+                finished = _write_album_part(pdf, output_dir, base_name, part)
+                pdf, used_bytes, part = _new_album_pdf(), 0, part + 1
+                # FPDF-objekt ingår i referenscykler; utan insamling här ligger färdiga delar kvar i minnet
+                gc.collect()
+                yield finished
+            _add_album_page(pdf, page, settings['margin_mm'])
+            used_bytes += cost
+        if progress: progress(done, len(story_items))
+    if pdf.page_no() > 0:
+        yield _write_album_part(pdf, output_dir, base_name, part)
+
+def generate_pdfs_from_story(service, story_items, settings=None, base_name='album', progress=None, image_cache=None, output_dir=None):
+    """Skapar albumet på disk; resultatet innehåller bara sökvägar, så jobbet håller inga PDF-data i minnet."""
+    output_dir = output_dir or tempfile.mkdtemp(prefix='album_')
+    try:
+        return {'pdfs': list(iter_album_pdfs(service, story_items, settings, base_name, progress, image_cache, output_dir))}
+    except Exception as e:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return {'error': f"Kunde inte skapa PDF-album: {drive_client.error_message(e)}"}
+
+def discard_album_pdfs(pdfs):
+    """Tar bort albumfiler från generate_pdfs_from_story() och deras katalog när den blivit tom."""
+    for album_pdf in pdfs:
+        try:
+            os.remove(album_pdf['path'])
+        except FileNotFoundError:
+            pass
+    for directory in {os.path.dirname(album_pdf['path']) for album_pdf in pdfs}:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+# --- Arkivering (Städ-guiden) ---
+
+class _ArchiveUpload(MediaUpload):
+    """Buffert mellan ZIP-skrivaren och en återupptagbar uppladdning.
+
+    zipfile skriver hit som till en fil och uppladdningen hämtar bitar med getbytes(). Byte som
+    Drive har bekräftat släpps och write() väntar när bufferten är full, så minnet är begränsat
+    oavsett hur stort arkivet blir.
+    """
+
+    def __init__(self, chunk_size=ARCHIVE_CHUNK_BYTES, max_buffered=ARCHIVE_BUFFER_BYTES):
+        self._chunk_size = chunk_size
+        self._max_buffered = max_buffered
+        self._data = bytearray()
+        self._offset = 0  # arkivets position för _data[0]
+        self._written = 0
+        self._closed = False
+        self._error = None
+        self._md5 = hashlib.md5()
+        self._condition = threading.Condition()
+
+    def write(self, data):
+        with self._condition:
+            while len(self._data) >= self._max_buffered and self._error is None:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+            self._data += data
+            self._written += len(data)
+            self._md5.update(data)
+            self._condition.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def abort(self, error):
+        """Stoppar både skrivning och uppladdning, så att ett halvfärdigt arkiv aldrig slutförs."""
+        with self._condition:
+            self._error = error
+            self._condition.notify_all()
+
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def wait_for_chunk(self, progress):
+        """Släpper byte före progress och väntar tills mer än en hel bit finns, eller arkivet är färdigskrivet.
+
+        En full bit skickas aldrig som sista bit innan storleken är känd, annars skulle uppladdningen
+        behöva avslutas med en tom bit.
+        """
+        with self._condition:
+            if progress > self._offset:
+                del self._data[:progress - self._offset]
+                self._offset = progress
+                self._condition.notify_all()
+            while not self._closed and self._error is None and self._written - progress <= self._chunk_size:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+
+    # --- MediaUpload ---
+
+    def chunksize(self):
+        return self._chunk_size
+
+    def mimetype(self):
+        return 'application/zip'
+
+    def size(self):
+        with self._condition:
+            return self._written if self._closed else None
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        with self._condition:
+            start = begin - self._offset
+            return bytes(self._data[start:start + length])
+
+def _unique_name(name, used):
+    # Drive tillåter flera filer med samma namn i en mapp, men inte ett ZIP-arkiv
+    base, extension = os.path.splitext(name)
+    candidate, counter = name, 2
+    while candidate.lower() in used:
+        candidate, counter = f"{base} ({counter}){extension}", counter + 1
+    used.add(candidate.lower())
+    return candidate
+
+def _list_archive_tree(service, folder_id):
+    """Listar mappen rekursivt och returnerar (filer, mappar, överhoppade).
+
+    Filer ges som (sökväg i arkivet, fil). Googles egna dokumenttyper har inget innehåll att
+    ladda ner och hoppas över.
+    """
+    files, folders, skipped = [], [], []
+    pending = deque([(folder_id, '')])
+    while pending:
+        current_id, prefix = pending.popleft()
+        query = f"'{current_id}' in parents and trashed = false"
+        items = sorted((item for page in iter_file_pages(service, query, ARCHIVE_FILE_FIELDS) for item in page), key=lambda item: item['name'].lower())
+        used = set()
+        for item in items:
+            path = prefix + _unique_name(item['name'].replace('/', '_'), used)
+            if item['mimeType'] == FOLDER_MIME_TYPE:
+                folders.append(path)
+                pending.append((item['id'], path + '/'))
+            elif item['mimeType'].startswith('application/vnd.google-apps.'):
+                skipped.append(path)
+            else:
+                files.append((path, item))
+    return files, folders, skipped
+
+def _download_archive_entry(service, item):
+    """Laddar ner filen till en mellanlagringsfil och kontrollerar den mot Drives md5Checksum."""
+    fh = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_BYTES)
+    try:
+        download_to_file(service, item['id'], fh)
+        md5 = hashlib.md5()
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            md5.update(block)
+        if item.get('md5Checksum') and md5.hexdigest() != item['md5Checksum']:
+            raise ValueError(f"Kontrollsumman för {item['name']} stämmer inte efter nedladdningen.")
+        fh.seek(0)
+        return fh
+    except BaseException:
+        fh.close()
+        raise
+
+def _iter_archive_downloads(service, files, prefetch=ARCHIVE_PREFETCH_FILES):
+    """Ger (sökväg, fil, mellanlagringsfil) i listningsordning medan de närmaste filerna laddas ner."""
+    executor = drive_client.download_pool()
+    window = deque()
+    entries = iter(files)
+    for path, item in entries:
+        window.append((path, item, executor.submit(_download_archive_entry, service, item)))
+        if len(window) >= prefetch:
+            break
+    try:
+        while window:
+            path, item, future = window.popleft()
+            next_entry = next(entries, None)
+            if next_entry is not None:
+                window.append((*next_entry, executor.submit(_download_archive_entry, service, next_entry[1])))
+            yield path, item, future.result()
+    finally:
+        # Vid avbrott ska redan nedladdade filer inte ligga kvar på disk
+        for path, item, future in window:
+            if not future.cancel() and future.exception() is None: future.result().close()
+
+def _zip_entry_info(path, item):
+    modified = item.get('modifiedTime', '')
+    try:
+        date_time = time.strptime(modified[:19], '%Y-%m-%dT%H:%M:%S')[:6]
+    except ValueError:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    info = zipfile.ZipInfo(path, date_time=max(date_time, (1980, 1, 1, 0, 0, 0)))
+    # JPEG och PDF är redan komprimerade; att packa om dem kostar CPU men sparar nästan inget
+    already_compressed = path.lower().endswith(ARCHIVE_STORED_EXTENSIONS) or item.get('mimeType', '').startswith(('image/jpeg', 'image/png', 'application/pdf', 'application/zip'))
+    info.compress_type = zipfile.ZIP_STORED if already_compressed else zipfile.ZIP_DEFLATED
+    info.file_size = int(item.get('size') or 0)
+    return info
+
+def _upload_archive(service, buffer, parent_id, filename):
+    client = drive_client.client_for(service)
+    request = service.files().create(body={'name': filename, 'parents': [parent_id], 'mimeType': 'application/zip'}, media_body=buffer, supportsAllDrives=True, fields='id, name, size, md5Checksum')
+    try:
+        response = None
+        while response is None:
+            buffer.wait_for_chunk(request.resumable_progress)
+            status, response = client.call(lambda http: request.next_chunk(http=http), method='files.create')
+        return response
+    except BaseException as e:
+        buffer.abort(e)
+        raise
+
+def archive_folder(service, folder_id, folder_name, cache=None, progress=None):
+    """Packar mappen med undermappar till en ZIP-fil i föräldramappen.
+
+    Filerna laddas ner parallellt och skrivs direkt in i arkivet, som laddas upp i bitar medan
+    det skapas; varken arkivet eller källmappen behöver få plats i minnet eller på disk. Innan
+    arkivet räknas som verifierat jämförs varje fil och hela arkivet mot Drives kontrollsummor,
+    och mappen listas om för att se att inget ändrats under tiden. Returnerar {'archive', 'parent_id',
+    'files', 'bytes', 'skipped', 'problems', 'verified'}.
+    """
+    try:
+        parents = drive_client.execute(service, service.files().get(fileId=folder_id, fields='parents', supportsAllDrives=True)).get('parents')
+        if not parents:
+            return {'error': "En hel enhet kan inte arkiveras. Välj en mapp."}
+        files, folders, skipped = _list_archive_tree(service, folder_id)
+        buffer = _ArchiveUpload()
+        upload = drive_client.upload_pool().submit(_upload_archive, service, buffer, parents[0], f"{folder_name}.zip")
+        try:
+            with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                for path in folders:
+                    archive.writestr(zipfile.ZipInfo(path + '/'), b'')
+                for done, (path, item, fh) in enumerate(_iter_archive_downloads(service, files), start=1):
+                    with fh, archive.open(_zip_entry_info(path, item), 'w') as entry:
+                        shutil.copyfileobj(fh, entry, 1024 * 1024)
+                    if progress: progress(done, len(files))
+            buffer.close()
+        except BaseException as e:
+            buffer.abort(e)
+            raise
+        uploaded = upload.result()
+
+        problems = []
+        if uploaded.get('md5Checksum') and uploaded['md5Checksum'] != buffer.md5():
+            problems.append("Arkivet i Drive har en annan kontrollsumma än det som skrevs.")
+        if skipped:
+            problems.append(f"{len(skipped)} Google-dokument kan inte packas i ett arkiv: {', '.join(skipped[:5])}")
+        # Filer som ändrats eller tillkommit under arkiveringen saknas i arkivet
+        archived = {item['id']: item.get('md5Checksum') for path, item in files}
+        current_files, current_folders, current_skipped = _list_archive_tree(service, folder_id)
+        changed = [path for path, item in current_files if archived.get(item['id']) != item.get('md5Checksum')]
+        if changed or len(current_files) != len(files):
+            problems.append(f"Källmappen har ändrats under arkiveringen: {', '.join(changed[:5]) or 'filer har tagits bort'}")
+        if cache: cache.invalidate_folder(parents[0])
+        return {'archive': uploaded, 'parent_id': parents[0], 'files': len(files), 'bytes': buffer.size(),
+                'skipped': skipped, 'problems': problems, 'verified': not problems}
     except Exception as e:
-        return {'error': f"Kunde inte dela upp PDF: {e}"}
+        return {'error': f"Kunde inte arkivera mappen: {drive_client.error_message(e)}"}
+
+def trash_folder(service, folder_id, parent_id=None, cache=None):
+    """Flyttar mappen till papperskorgen, där den kan återställas i 30 dagar."""
+    try:
+        drive_client.execute(service, service.files().update(fileId=folder_id, body={'trashed': True}, supportsAllDrives=True, fields='id'))
+        if cache: cache.invalidate_file(folder_id, [parent_id] if parent_id else ())
+        return {'success': True}
+    except HttpError as e:
+        return {'error': f"Kunde inte ta bort mappen: {drive_client.error_message(e)}"}
@@ -1,15 +1,20 @@
 import streamlit as st
 import os
+import uuid
+import hashlib
+import tempfile
 import requests
 from urllib.parse import urlencode
 
 # Importera Googles bibliotek
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
 
 # Importera vår motor
 import pdf_motor
+import job_runner
+import drive_client
+import drive_metrics
 
 # --- Konfiguration ---
 CLIENT_ID = st.secrets.get("GOOGLE_CLIENT_ID")
@@ -18,6 +23,15 @@ REDIRECT_URI = st.secrets.get("APP_URL")
 SCOPES = ['https://www.googleapis.com/auth/drive']
 TOKEN_URI = 'https://oauth2.googleapis.com/token'
 AUTH_URI = 'https://accounts.google.com/o/oauth2/v2/auth'
+PREVIEW_ITEM_COUNT = 20
+BOARD_PAGE_SIZE = 50
+JOB_POLL_SECONDS = 1
+JOB_LABELS = {'reload': "Läser in mappen", 'split': "Delar upp PDF", 'generate': "Skapar PDF-album", 'archive': "Arkiverar källmappen"}
+ACTION_LABELS = {**JOB_LABELS, 'rerun': "Omkörning", 'save_order': "Sparar ordningen", 'prefetch': "Förhämtning av mappar"}
+DEBUG_ACTION_COUNT = 10
+CACHE_DIR = tempfile.gettempdir()
+THUMBNAIL_CACHE_DIR = os.path.join(CACHE_DIR, "berattelsebyggaren_miniatyrer")
+ALBUM_IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, "berattelsebyggaren_albumbilder")
 
 # --- Inloggningslogik ---
 def get_auth_url():
@@ -33,20 +47,221 @@ def exchange_code_for_service(auth_code):
         credentials_data['client_id'] = CLIENT_ID
         credentials_data['client_secret'] = CLIENT_SECRET
         credentials = Credentials.from_authorized_user_info(credentials_data, SCOPES)
-        drive_service = build('drive', 'v3', credentials=credentials)
+        drive_service = drive_client.build_service(credentials)
         return drive_service
     except Exception as e:
         st.error(f"Ett fel inträffade vid inloggning: {e}")
         return None
 
+def open_drive_cache(user_email):
+    """Öppnar användarens egen diskcache så att listningar inte delas mellan konton."""
+    key = hashlib.sha256(user_email.encode('utf-8')).hexdigest()[:16]
+    return pdf_motor.DriveCache(os.path.join(CACHE_DIR, f"berattelsebyggaren_{key}.sqlite"))
+
+@st.cache_resource
+def get_thumbnail_cache():
+    """Miniatyrcachen är innehållsadresserad och delas därför mellan alla sessioner."""
+    return pdf_motor.ImageCache(THUMBNAIL_CACHE_DIR)
+
+@st.cache_resource
+def get_album_image_cache():
+    """Förberedda albumbilder memoiseras per checksumma och inställningar, så en omgenerering
+    efter en liten ändring bara kodar om de bilder som faktiskt ändrats."""
+    return pdf_motor.ImageCache(ALBUM_IMAGE_CACHE_DIR, max_bytes=pdf_motor.ALBUM_IMAGE_CACHE_MAX_BYTES)
+
+def toggle_selection(file_id):
+    """Valda objekt sparas per fil-ID, så valet överlever att raden inte renderas."""
+    st.session_state.selected_ids ^= {file_id}
+
+def change_page(state_key, step):
+    """Callback för sidväljaren; sidan byts före omkörningen så att knapparna visas rätt."""
+    st.session_state[state_key] = st.session_state.get(state_key, 0) + step
+
+def render_pager(items, state_key, page_size=BOARD_PAGE_SIZE):
+    """Visar sidväljare och returnerar (startindex, objekten på aktuell sida)."""
+    page_count = max(1, -(-len(items) // page_size))
+    page = max(0, min(st.session_state.get(state_key, 0), page_count - 1))
+    if page_count > 1:
+        c1, c2, c3 = st.columns([1, 3, 1])
+        c1.button("◀", key=f"{state_key}_prev", disabled=page == 0, use_container_width=True, on_click=change_page, args=(state_key, -1))
+        c3.button("▶", key=f"{state_key}_next", disabled=page >= page_count - 1, use_container_width=True, on_click=change_page, args=(state_key, 1))
+        c2.caption(f"Sida {page + 1} av {page_count} ({len(items)} objekt)")
+    st.session_state[state_key] = page
+    start = page * page_size
+    return start, items[start:start + page_size]
+
+def queue_story_order_save():
+    """Schemalägger en sparning av ordningen; snabba ändringar slås ihop till en skrivning."""
+    if st.session_state.order_writer: st.session_state.order_writer.schedule(st.session_state.story_items)
+
+@st.cache_resource
+def get_job_runner():
+    """Jobbkörningen delas av alla sessioner och lever vidare mellan omkörningar."""
+    return job_runner.JobRunner()
+
+def job_owner():
+    """Jobb knyts till kontot, så att en ny flik kan se jobb som startades i en annan.
+
+    Resultatet tas bara om hand av sessionen som startade jobbet; se submit_job().
+    """
+    if st.session_state.user_email and st.session_state.user_email != "Okänd": return st.session_state.user_email
+    return st.session_state.session_id
+
+def submit_job(kind, fn, *args, **kwargs):
+    """Startar ett bakgrundsjobb vars resultat tas om hand av den här sessionen."""
+    return get_job_runner().submit(job_owner(), kind, fn, *args, session_id=st.session_state.session_id, **kwargs)
+
+def visible_jobs():
+    """Egna jobb samt pågående jobb som kontot startat i andra flikar."""
+    return [job for job in get_job_runner().jobs_for(job_owner()) if job['session_id'] == st.session_state.session_id or job['state'] in ('queued', 'running')]
+
+@st.cache_resource
+def get_prefetch_pool():
+    """Förhämtningen får en egen liten pool, så att den aldrig tränger undan användarens jobb."""
+    return drive_metrics.ThreadPool(max_workers=2)
+
+def current_folder_tree():
+    """Den valda enhetens mappträd; hålls i sessionen så länge Drive-cachen anser det aktuellt.
+
+    Returnerar None om enheten inte är känd (t.ex. en session från före mappträdet).
+    """
+    if st.session_state.current_drive is None: return None
+    drive_id = st.session_state.current_drive[0]
+    tree = pdf_motor.load_folder_tree(st.session_state.drive_service, drive_id, cache=st.session_state.drive_cache, current=st.session_state.folder_trees.get(drive_id))
+    if isinstance(tree, pdf_motor.FolderTree): st.session_state.folder_trees[drive_id] = tree
+    return tree
+
+def open_folder(folder_id, folder_name, path_history):
+    """Callback för mappknapparna; sökvägen kommer från minnet, inte från Drive."""
+    st.session_state.current_folder_id, st.session_state.current_folder_name = folder_id, folder_name
+    st.session_state.path_history = path_history
+    st.session_state.story_items = None
+    st.session_state.folder_search = ""
+
+def prefetch_folders(folders):
+    """Hämtar aktuell mapps och de första undermapparnas filistningar i bakgrunden."""
+    if not st.session_state.drive_cache: return
+    folder_ids = [st.session_state.current_folder_id] + [folder['id'] for folder in folders[:pdf_motor.PREFETCH_FOLDER_COUNT]]
+    get_prefetch_pool().submit(pdf_motor.prefetch_folder_listings, st.session_state.drive_service, folder_ids, st.session_state.drive_cache, job_owner())
+
 def reload_story_items():
-    """Hjälpfunktion för att ladda om fillistan efter en ändring."""
-    with st.spinner("Uppdaterar fillista..."):
-        result = pdf_motor.get_content_units_from_folder(st.session_state.drive_service, st.session_state.current_folder_id)
-        if 'error' in result: st.error(result['error'])
-        elif 'units' in result: st.session_state.story_items = result['units']
+    """Startar inläsning av aktuell mapp som bakgrundsjobb."""
+    # Väntande ändringar måste skrivas innan ordningen läses tillbaka
+    if st.session_state.order_writer: st.session_state.order_writer.flush()
+    submit_job('reload', pdf_motor.get_content_units_from_folder, st.session_state.drive_service, st.session_state.current_folder_id,
+                            cache=st.session_state.drive_cache, context={'folder_id': st.session_state.current_folder_id})
+    st.rerun()
+
+def set_album_pdfs(pdfs):
+    """Byter ut albumfilerna; de tidigare tas bort från disk."""
+    pdf_motor.discard_album_pdfs(st.session_state.album_pdfs)
+    st.session_state.album_pdfs = pdfs
+
+def album_pdf_data(path):
+    """Albumfilen läses först när användaren klickar, så att PDF:en aldrig ligger i sessionen."""
+    def read():
+        with open(path, 'rb') as fh: return fh.read()
+    return read
+
+def apply_job_result(job):
+    """Tar hand om resultatet av ett avslutat jobb. Resultat för en annan mapp än den aktuella kastas."""
+    if job['context'].get('folder_id') != st.session_state.current_folder_id:
+        if job['kind'] == 'generate': pdf_motor.discard_album_pdfs(job['result']['pdfs'])
+        return
+    result = job['result']
+    if job['kind'] == 'reload':
+        st.session_state.story_items = result['units']
+        st.session_state.order_writer = pdf_motor.StoryOrderWriter(st.session_state.drive_service, st.session_state.current_folder_id, result['project_file'], cache=st.session_state.drive_cache, owner=job_owner())
+        set_album_pdfs([])
+    elif job['kind'] == 'split' and st.session_state.story_items is not None:
+        # Objektet kan ha flyttats medan jobbet körde, så det letas upp på nytt via sitt ID
+        index = next((i for i, item in enumerate(st.session_state.story_items) if item['id'] == job['context']['item_id']), None)
+        if index is not None:
+            st.session_state.story_items[index:index + 1] = result['new_files']
+            queue_story_order_save()
+    elif job['kind'] == 'generate':
+        set_album_pdfs(result['pdfs'])
+    elif job['kind'] == 'archive':
+        st.session_state.archive_result = {**result, 'folder_id': job['context']['folder_id']}
+
+def render_jobs():
+    """Visar pågående bakgrundsjobb och tar hand om dem som har blivit klara."""
+    runner = get_job_runner()
+    finished = False
+    for job in visible_jobs():
+        own = job['session_id'] == st.session_state.session_id
+        label = JOB_LABELS.get(job['kind'], job['kind']) + ("" if own else " (annan flik)")
+        if job['state'] in ('queued', 'running'):
+            if job['total']: st.progress(job['done'] / job['total'], text=f"{label}: {job['done']} av {job['total']}")
+            else: st.caption(f"{label}: {job['done']} klara...")
+            if own and job['kind'] == 'reload' and job['partial']:
+                # Visa första skärmfullen medan resten av mappen fortfarande listas
+                for unit in job['partial'][:PREVIEW_ITEM_COUNT]: st.write(unit['filename'])
+        else:
+            runner.forget(job['id'])
+            if job['state'] == 'error': st.session_state.job_errors.append(f"{label}: {job['error']}")
+            else: apply_job_result(job)
+            finished = True
+    if finished: st.rerun()
+
+def render_jobs_panel():
+    # Fragmentet körs om på egen hand och frågar efter status bara medan det finns jobb
+    if visible_jobs(): st.fragment(run_every=JOB_POLL_SECONDS)(render_jobs)()
+    for message in st.session_state.job_errors: st.error(message)
+    st.session_state.job_errors = []
+
+@st.dialog("Städ-guiden")
+def cleanup_wizard():
+    """Låter användaren välja vad som ska hända med källmappen när albumet är klart."""
+    st.markdown(f"Vad vill du göra med källmappen **{st.session_state.current_folder_name}**?")
+    st.markdown("**Behåll allt** – källmappen och de färdiga PDF-filerna lämnas orörda.")
+    if st.button("Behåll allt", use_container_width=True): st.rerun()
+    st.markdown("**Arkivera** – hela källmappen packas i en .zip-fil bredvid mappen. När arkivet är kontrollerat "
+                "får du välja om källmappen ska flyttas till papperskorgen.")
+    if st.button("Arkivera 🗜️", type="primary", use_container_width=True):
+        st.session_state.archive_result = None
+        submit_job('archive', pdf_motor.archive_folder, st.session_state.drive_service, st.session_state.current_folder_id,
+                                st.session_state.current_folder_name, cache=st.session_state.drive_cache, context={'folder_id': st.session_state.current_folder_id})
+        st.rerun()
+
+def trash_source_folder():
+    """Flyttar den arkiverade källmappen till papperskorgen och går upp en nivå."""
+    if st.session_state.order_writer: st.session_state.order_writer.flush()
+    result = pdf_motor.trash_folder(st.session_state.drive_service, st.session_state.current_folder_id, st.session_state.archive_result['parent_id'], cache=st.session_state.drive_cache)
+    if 'error' in result:
+        st.session_state.job_errors.append(result['error'])
+        return
+    if st.session_state.path_history: st.session_state.current_folder_id, st.session_state.current_folder_name = st.session_state.path_history.pop()
+    else: st.session_state.current_folder_id = None
+    st.session_state.story_items, st.session_state.order_writer, st.session_state.archive_result = None, None, None
+    set_album_pdfs([])
     st.rerun()
 
+def render_archive_status():
+    result = st.session_state.archive_result
+    if not result or result['folder_id'] != st.session_state.current_folder_id: return
+    size_mb = result['bytes'] / (1024 * 1024)
+    if result['verified']:
+        st.success(f"Arkivet {result['archive']['name']} är kontrollerat: {result['files']} filer, {size_mb:.1f} MB.")
+        if st.button("🗑️ Flytta källmappen till papperskorgen", use_container_width=True): trash_source_folder()
+    else:
+        st.warning(f"Arkivet {result['archive']['name']} skapades ({result['files']} filer, {size_mb:.1f} MB), men källmappen bör inte tas bort:")
+        for problem in result['problems']: st.write(f"- {problem}")
+
+def render_debug_panel():
+    """Visar Drive-anrop per åtgärd: antal, byte, svarstider och omförsök."""
+    actions = drive_metrics.recent_actions(job_owner())
+    if not actions:
+        st.caption("Inga mätningar ännu.")
+        return
+    for action in actions[:DEBUG_ACTION_COUNT]:
+        label = ACTION_LABELS.get(action['action'], action['action'])
+        st.markdown(f"**{label}**: {action['calls']} anrop, {action['retries']} omförsök, {action['errors']} fel, "
+                    f"{(action['bytes_sent'] + action['bytes_received']) / 1024:.0f} kB, {action['duration_ms']:.0f} ms")
+        if action['methods']:
+            st.dataframe([{'anrop': method, **stats} for method, stats in action['methods'].items()], hide_index=True, use_container_width=True)
+    st.download_button("⬇️ Exportera mätvärden (JSON)", drive_metrics.export_json(job_owner()), file_name="drive_matvarden.json", mime='application/json', use_container_width=True)
+
 # --- Applikationens Flöde ---
 st.set_page_config(layout="wide")
 st.title("Berättelsebyggaren")
@@ -56,8 +271,11 @@ def initialize_state():
     defaults = {
         'drive_service': None, 'user_email': None, 'story_items': None, 'path_history': [], 
         'current_folder_id': None, 'current_folder_name': None, 'organize_mode': False, 
-        'selected_indices': set(), 'clipboard': [], 'quick_sort_mode': False, 
-        'unsorted_items': []
+        'selected_ids': set(), 'clipboard': [], 'quick_sort_mode': False, 
+        'unsorted_items': [], 'drive_cache': None, 'order_writer': None,
+        'album_pdfs': [], 'job_errors': [], 'session_id': uuid.uuid4().hex,
+        'show_debug': False, 'archive_result': None,
+        'current_drive': None, 'folder_trees': {}
     }
     for key, value in defaults.items():
         if key not in st.session_state: st.session_state[key] = value
@@ -71,8 +289,9 @@ if auth_code and st.session_state.drive_service is None:
         st.session_state.drive_service = exchange_code_for_service(auth_code)
         if st.session_state.drive_service:
             try:
-                user_info = st.session_state.drive_service.about().get(fields='user').execute()
+                user_info = drive_client.execute(st.session_state.drive_service, st.session_state.drive_service.about().get(fields='user'))
                 st.session_state.user_email = user_info['user']['emailAddress']
+                st.session_state.drive_cache = open_drive_cache(st.session_state.user_email)
             except Exception: st.session_state.user_email = "Okänd"
         st.query_params.clear()
         st.rerun()
@@ -91,147 +310,198 @@ if st.session_state.drive_service is None:
 
 else:
     # Användaren ÄR inloggad!
-    col_main, col_sidebar = st.columns([3, 1])
+    # Varje körning mäts som en åtgärd. measure() avslutar den även när st.rerun() avbryter skriptet,
+    # så att tiden fram till nästa interaktion inte räknas in
+    with drive_metrics.measure('rerun', job_owner()):
+        # En billig ändringsfråga per körning håller cachen aktuell
+        if st.session_state.drive_cache: st.session_state.drive_cache.sync(st.session_state.drive_service)
+        col_main, col_sidebar = st.columns([3, 1])
 
-    with col_sidebar:
-        st.markdown(f"**Ansluten som:**\n{st.session_state.user_email}")
-        st.divider()
+        with col_sidebar:
+            st.markdown(f"**Ansluten som:**\n{st.session_state.user_email}")
+            st.divider()
         
-        # FILBLÄDDRARE (om inte i snabbsortering)
-        if not st.session_state.quick_sort_mode:
-            st.markdown("### Välj Källmapp")
-            if st.session_state.current_folder_id is None:
-                drives = pdf_motor.get_available_drives(st.session_state.drive_service)
-                if 'error' in drives: st.error(drives['error'])
+            # FILBLÄDDRARE (om inte i snabbsortering)
+            if not st.session_state.quick_sort_mode:
+                st.markdown("### Välj Källmapp")
+                if st.session_state.current_folder_id is None:
+                    drives = pdf_motor.get_available_drives(st.session_state.drive_service)
+                    if 'error' in drives: st.error(drives['error'])
+                    else:
+                        for drive in sorted(drives, key=lambda x: x.get('name', '').lower()):
+                            icon = "📁" if drive.get('id') == 'root' else "🏢"
+                            if st.button(f"{icon} {drive.get('name', 'Okänd enhet')}", use_container_width=True, key=drive.get('id')):
+                                st.session_state.current_folder_id, st.session_state.current_folder_name = drive.get('id'), drive.get('name')
+                                st.session_state.current_drive = (drive.get('id'), drive.get('name'))
+                                st.session_state.path_history = []
+                                st.rerun()
                 else:
-                    for drive in sorted(drives, key=lambda x: x.get('name', '').lower()):
-                        icon = "📁" if drive.get('id') == 'root' else "🏢"
-                        if st.button(f"{icon} {drive.get('name', 'Okänd enhet')}", use_container_width=True, key=drive.get('id')):
-                            st.session_state.current_folder_id, st.session_state.current_folder_name = drive.get('id'), drive.get('name')
-                            st.session_state.path_history = []
-                            st.rerun()
-            else:
-                path_parts = [name for id, name in st.session_state.path_history] + [st.session_state.current_folder_name]
-                st.write(f"**Plats:** `{' / '.join(path_parts)}`")
-                c1, c2 = st.columns(2)
-                if c1.button("⬅️ Byt enhet", use_container_width=True):
-                    st.session_state.current_folder_id, st.session_state.path_history, st.session_state.story_items = None, [], None
-                    st.rerun()
-                if c2.button("⬆️ Gå upp", use_container_width=True, disabled=not st.session_state.path_history):
-                    prev_id, prev_name = st.session_state.path_history.pop()
-                    st.session_state.current_folder_id, st.session_state.current_folder_name = prev_id, prev_name
-                    st.session_state.story_items = None
-                    st.rerun()
-                if st.button("✅ Läs in denna mapp", type="primary", use_container_width=True):
-                    reload_story_items()
-
-                folders = pdf_motor.list_folders(st.session_state.drive_service, st.session_state.current_folder_id)
-                if 'error' in folders: st.error(folders['error'])
-                elif folders:
-                    st.markdown("*Undermappar:*")
-                    for folder in sorted(folders, key=lambda x: x.get('name', '').lower()):
-                        if st.button(f"📁 {folder.get('name', 'Okänd mapp')}", key=folder.get('id'), use_container_width=True):
-                            st.session_state.path_history.append((st.session_state.current_folder_id, st.session_state.current_folder_name))
-                            st.session_state.current_folder_id, st.session_state.current_folder_name = folder.get('id'), folder.get('name')
-                            st.session_state.story_items = None
-                            st.rerun()
+                    path_parts = [name for id, name in st.session_state.path_history] + [st.session_state.current_folder_name]
+                    st.write(f"**Plats:** `{' / '.join(path_parts)}`")
+                    c1, c2 = st.columns(2)
+                    if c1.button("⬅️ Byt enhet", use_container_width=True):
+                        st.session_state.current_folder_id, st.session_state.path_history, st.session_state.story_items = None, [], None
+                        st.session_state.current_drive, st.session_state.folder_search = None, ""
+                        st.rerun()
+                    if c2.button("⬆️ Gå upp", use_container_width=True, disabled=not st.session_state.path_history):
+                        prev_id, prev_name = st.session_state.path_history.pop()
+                        st.session_state.current_folder_id, st.session_state.current_folder_name = prev_id, prev_name
+                        st.session_state.story_items = None
+                        st.rerun()
+                    if st.button("✅ Läs in denna mapp", type="primary", use_container_width=True):
+                        reload_story_items()
+
+                    # Navigering och sökning besvaras från enhetens mappträd; bara om det inte går att hämta listas mappen direkt
+                    tree = current_folder_tree()
+                    if not isinstance(tree, pdf_motor.FolderTree):
+                        if tree is not None: st.error(tree['error'])
+                        folders = pdf_motor.list_folders(st.session_state.drive_service, st.session_state.current_folder_id, cache=st.session_state.drive_cache)
+                    else:
+                        folders = tree.children(st.session_state.current_folder_id)
+                        search = st.text_input("🔍 Sök mapp", key='folder_search', placeholder=f"Sök bland {len(tree)} mappar")
+                        matches = tree.search(search)
+                        for match in matches:
+                            label = ' / '.join([name for id, name in match['path']] + [match['name']])
+                            st.button(f"🔎 {label}", key=f"search_{match['id']}", use_container_width=True,
+                                      on_click=open_folder, args=(match['id'], match['name'], [st.session_state.current_drive] + match['path']))
+                        if search.strip() and not matches: st.caption("Inga mappar matchar sökningen.")
+                        prefetch_folders(folders)
+                    if 'error' in folders: st.error(folders['error'])
+                    elif folders:
+                        st.markdown("*Undermappar:*")
+                        child_path = st.session_state.path_history + [(st.session_state.current_folder_id, st.session_state.current_folder_name)]
+                        for folder in sorted(folders, key=lambda x: x.get('name', '').lower()):
+                            st.button(f"📁 {folder.get('name', 'Okänd mapp')}", key=folder.get('id'), use_container_width=True,
+                                      on_click=open_folder, args=(folder.get('id'), folder.get('name'), child_path))
         
-        # VERKTYG FÖR ORGANISERING
-        if st.session_state.story_items is not None and st.session_state.organize_mode:
-            st.divider()
-            st.markdown("### Verktyg")
-            st.info("Dina originalfiler raderas eller ändras aldrig.", icon="ℹ️")
-
-            if st.button("Starta Snabbsortering 🔢", disabled=st.session_state.quick_sort_mode, use_container_width=True):
-                st.session_state.quick_sort_mode = True
-                with st.spinner("Förbereder..."):
-                    all_files_result = pdf_motor.get_content_units_from_folder(st.session_state.drive_service, st.session_state.current_folder_id)
-                    if 'units' in all_files_result:
-                        all_items_map = {item['filename']: item for item in all_files_result['units']}
-                        sorted_filenames = {item['filename'] for item in st.session_state.story_items}
-                        unsorted = [item for filename, item in all_items_map.items() if filename not in sorted_filenames]
-                        st.session_state.unsorted_items = sorted(unsorted, key=lambda x: x['filename'].lower())
-                st.rerun()
-
-            selected_indices = {i for i, item in enumerate(st.session_state.story_items) if st.session_state.get(f"select_{item['id']}")}
-            st.info(f"{len(selected_indices)} objekt valda.")
+            # VERKTYG FÖR ORGANISERING
+            if st.session_state.story_items is not None and st.session_state.organize_mode:
+                st.divider()
+                st.markdown("### Verktyg")
+                st.info("Dina originalfiler raderas eller ändras aldrig.", icon="ℹ️")
+
+                if st.button("Starta Snabbsortering 🔢", disabled=st.session_state.quick_sort_mode, use_container_width=True):
+                    st.session_state.quick_sort_mode = True
+                    with st.spinner("Förbereder..."):
+                        all_files_result = pdf_motor.get_content_units_from_folder(st.session_state.drive_service, st.session_state.current_folder_id, cache=st.session_state.drive_cache)
+                        if 'units' in all_files_result:
+                            all_items_map = {item['filename']: item for item in all_files_result['units']}
+                            sorted_filenames = {item['filename'] for item in st.session_state.story_items}
+                            unsorted = [item for filename, item in all_items_map.items() if filename not in sorted_filenames]
+                            st.session_state.unsorted_items = sorted(unsorted, key=lambda x: x['filename'].lower())
+                    st.rerun()
+
+                selected_indices = {i for i, item in enumerate(st.session_state.story_items) if item['id'] in st.session_state.selected_ids}
+                st.info(f"{len(selected_indices)} objekt valda.")
             
-            tool_cols = st.columns(2)
-            if tool_cols[0].button("Klipp ut 📤", disabled=not selected_indices, use_container_width=True):
-                st.session_state.clipboard = [st.session_state.story_items[i] for i in sorted(list(selected_indices))]
-                for i in sorted(list(selected_indices), reverse=True): del st.session_state.story_items[i]
-                pdf_motor.save_story_order(st.session_state.drive_service, st.session_state.current_folder_id, st.session_state.story_items)
-                st.rerun()
-            if tool_cols[1].button("Klistra in 📥", disabled=not st.session_state.clipboard, use_container_width=True):
-                st.session_state.story_items = st.session_state.clipboard + st.session_state.story_items
-                st.session_state.clipboard = []
-                pdf_motor.save_story_order(st.session_state.drive_service, st.session_state.current_folder_id, st.session_state.story_items)
-                st.rerun()
+                tool_cols = st.columns(2)
+                if tool_cols[0].button("Klipp ut 📤", disabled=not selected_indices, use_container_width=True):
+                    st.session_state.clipboard = [st.session_state.story_items[i] for i in sorted(list(selected_indices))]
+                    for i in sorted(list(selected_indices), reverse=True): del st.session_state.story_items[i]
+                    st.session_state.selected_ids = set()
+                    queue_story_order_save()
+                    st.rerun()
+                if tool_cols[1].button("Klistra in 📥", disabled=not st.session_state.clipboard, use_container_width=True):
+                    st.session_state.story_items = st.session_state.clipboard + st.session_state.story_items
+                    st.session_state.clipboard = []
+                    queue_story_order_save()
+                    st.rerun()
             
-            if st.session_state.clipboard: st.success(f"{len(st.session_state.clipboard)} i urklipp.")
+                if st.session_state.clipboard: st.success(f"{len(st.session_state.clipboard)} i urklipp.")
             
-            if st.button("Ta bort 🗑️", type="primary", disabled=not selected_indices, use_container_width=True):
-                for i in sorted(list(selected_indices), reverse=True): del st.session_state.story_items[i]
-                pdf_motor.save_story_order(st.session_state.drive_service, st.session_state.current_folder_id, st.session_state.story_items)
-                st.rerun()
-
-    with col_main:
-        if st.session_state.story_items is not None and st.session_state.quick_sort_mode:
-            st.warning("SNABBSORTERINGS-LÄGE AKTIVT")
-            if st.button("✅ Avsluta Snabbsortering och spara"):
-                if st.session_state.unsorted_items: st.session_state.story_items.extend(st.session_state.unsorted_items)
-                pdf_motor.save_story_order(st.session_state.drive_service, st.session_state.current_folder_id, st.session_state.story_items)
-                st.session_state.quick_sort_mode = False
-                st.rerun()
+                if st.button("Ta bort 🗑️", type="primary", disabled=not selected_indices, use_container_width=True):
+                    for i in sorted(list(selected_indices), reverse=True): del st.session_state.story_items[i]
+                    st.session_state.selected_ids = set()
+                    queue_story_order_save()
+                    st.rerun()
+
+            # INSTÄLLNINGAR & PUBLICERING
+            if st.session_state.story_items and not st.session_state.quick_sort_mode:
+                st.divider()
+                st.markdown("### Inställningar & Publicering")
+                quality = st.slider("Bildkvalitet", min_value=30, max_value=95, value=pdf_motor.ALBUM_DEFAULT_SETTINGS['quality'])
+                max_mb = st.number_input("Maximal filstorlek (MB)", min_value=1.0, value=pdf_motor.ALBUM_DEFAULT_SETTINGS['max_mb'], step=1.0)
+                margin_mm = st.number_input("Marginal runt innehåll (mm)", min_value=0.0, value=pdf_motor.ALBUM_DEFAULT_SETTINGS['margin_mm'], step=1.0)
+                generating = get_job_runner().is_active(job_owner(), 'generate', {'folder_id': st.session_state.current_folder_id})
+                if st.button("Skapa PDF-album 📚", use_container_width=True, disabled=generating):
+                    submit_job('generate', pdf_motor.generate_pdfs_from_story, st.session_state.drive_service, list(st.session_state.story_items),
+                                            {'quality': quality, 'max_mb': max_mb, 'margin_mm': margin_mm},
+                                            base_name=st.session_state.current_folder_name or 'album', image_cache=get_album_image_cache(),
+                                            context={'folder_id': st.session_state.current_folder_id})
+                    st.rerun()
+                for album_pdf in st.session_state.album_pdfs:
+                    st.download_button(f"⬇️ {album_pdf['filename']}", album_pdf_data(album_pdf['path']), file_name=album_pdf['filename'], mime='application/pdf', use_container_width=True)
+                archiving = get_job_runner().is_active(job_owner(), 'archive', {'folder_id': st.session_state.current_folder_id})
+                if st.session_state.album_pdfs and st.button("Hantera källfiler...", use_container_width=True, disabled=archiving): cleanup_wizard()
+                render_archive_status()
+
+            # FELSÖKNING
+            st.divider()
+            if st.toggle("Visa Drive-prestanda", key='show_debug'):
+                render_debug_panel()
+
+        with col_main:
+            render_jobs_panel()
+            save_result = st.session_state.order_writer.last_result if st.session_state.order_writer else None
+            if save_result and 'error' in save_result: st.warning(save_result['error'])
+            if st.session_state.story_items is not None and st.session_state.quick_sort_mode:
+                st.warning("SNABBSORTERINGS-LÄGE AKTIVT")
+                if st.button("✅ Avsluta Snabbsortering och spara"):
+                    if st.session_state.unsorted_items: st.session_state.story_items.extend(st.session_state.unsorted_items)
+                    queue_story_order_save()
+                    if st.session_state.order_writer: st.session_state.order_writer.flush()
+                    st.session_state.quick_sort_mode = False
+                    st.rerun()
             
-            qs_col1, qs_col2 = st.columns(2)
-            with qs_col1:
-                st.markdown("#### Kvar att sortera")
-                with st.container(height=600):
-                    for i, item in enumerate(st.session_state.unsorted_items):
-                        if st.button(f"➕ {item['filename']}", key=f"add_{item['id']}", use_container_width=True):
-                            st.session_state.story_items.append(item)
-                            st.session_state.unsorted_items.pop(i)
-                            st.rerun()
-            with qs_col2:
-                st.markdown("#### Din Berättelse (i ordning)")
-                with st.container(height=600):
-                    if not st.session_state.story_items: st.info("Börja genom att klicka.")
-                    for item in st.session_state.story_items:
-                        i_col1, i_col2 = st.columns([1,5])
-                        if item.get('type') == 'image' and item.get('thumbnail'): i_col1.image(item['thumbnail'], width=75)
-                        elif item.get('type') == 'pdf': i_col1.markdown("📑")
-                        elif item.get('type') == 'text': i_col1.markdown("📄")
-                        i_col2.write(item.get('filename'))
+                qs_col1, qs_col2 = st.columns(2)
+                with qs_col1:
+                    st.markdown("#### Kvar att sortera")
+                    start, window = render_pager(st.session_state.unsorted_items, 'unsorted_page')
+                    with st.container(height=600):
+                        for i, item in enumerate(window, start):
+                            if st.button(f"➕ {item['filename']}", key=f"add_{item['id']}", use_container_width=True):
+                                st.session_state.story_items.append(item)
+                                st.session_state.unsorted_items.pop(i)
+                                st.rerun()
+                with qs_col2:
+                    st.markdown("#### Din Berättelse (i ordning)")
+                    start, window = render_pager(st.session_state.story_items, 'quick_sort_story_page')
+                    with st.container(height=600):
+                        if not st.session_state.story_items: st.info("Börja genom att klicka.")
+                        thumbnails = pdf_motor.get_thumbnails(st.session_state.drive_service, window, get_thumbnail_cache())
+                        for item in window:
+                            i_col1, i_col2 = st.columns([1,5])
+                            if thumbnails.get(item['id']): i_col1.image(thumbnails[item['id']], width=75)
+                            elif item.get('type') == 'image': i_col1.markdown("🖼️")
+                            elif item.get('type') == 'pdf': i_col1.markdown("📑")
+                            elif item.get('type') == 'text': i_col1.markdown("📄")
+                            i_col2.write(item.get('filename'))
         
-        elif st.session_state.story_items is not None:
-            st.toggle("Ändra ordning & innehåll (Organisera-läge)", key="organize_mode")
-            st.markdown("### Berättelsens flöde")
-            for i, item in enumerate(st.session_state.story_items):
-                with st.container():
-                    cols = [1, 10] if not st.session_state.organize_mode else [0.5, 1, 10]
-                    col_list = st.columns(cols)
-                    if st.session_state.organize_mode: col_list[0].checkbox("", key=f"select_{item['id']}")
-                    with col_list[-2]:
-                        if item.get('type') == 'image' and item.get('thumbnail'): st.image(item['thumbnail'], width=100)
-                        elif item.get('type') == 'pdf' and item.get('thumbnail'):
-                             st.image(item['thumbnail'], width=100)
-                        elif item.get('type') == 'pdf':
-                             st.markdown("<p style='font-size: 48px;'>📑</p>", unsafe_allow_html=True)
-                        elif item.get('type') == 'text' and 'content' in item: st.info(item.get('content'))
-                        elif item.get('type') == 'text': st.markdown("<p style='font-size: 48px;'>📄</p>", unsafe_allow_html=True)
-                    with col_list[-1]:
-                        st.write(item.get('filename'))
-                        if st.session_state.organize_mode and item['type'] == 'pdf':
-                           if st.button("Dela upp ✂️", key=f"split_{item['id']}"):
-                                with st.spinner(f"Delar upp {item['filename']}..."):
-                                    result = pdf_motor.split_pdf_and_upload(st.session_state.drive_service, item['id'], item['filename'], st.session_state.current_folder_id)
-                                    if 'error' in result: st.error(result['error'])
-                                    elif 'new_files' in result:
-                                        st.session_state.story_items = st.session_state.story_items[:i] + result['new_files'] + st.session_state.story_items[i+1:]
-                                        pdf_motor.save_story_order(st.session_state.drive_service, st.session_state.current_folder_id, st.session_state.story_items)
-                                        st.success("PDF uppdelad!")
-                                        reload_story_items()
-                st.divider()
-        else:
-            st.info("⬅️ Använd filbläddraren för att börja.")
+            elif st.session_state.story_items is not None:
+                st.toggle("Ändra ordning & innehåll (Organisera-läge)", key="organize_mode")
+                st.markdown("### Berättelsens flöde")
+                # Bara aktuell sida byggs upp, så en omkörning kostar lika mycket oavsett berättelsens längd
+                start, window = render_pager(st.session_state.story_items, 'board_page')
+                thumbnails = pdf_motor.get_thumbnails(st.session_state.drive_service, window, get_thumbnail_cache())
+                for item in window:
+                    with st.container():
+                        cols = [1, 10] if not st.session_state.organize_mode else [0.5, 1, 10]
+                        col_list = st.columns(cols)
+                        if st.session_state.organize_mode: col_list[0].checkbox("Välj", label_visibility="collapsed", key=f"select_{item['id']}", value=item['id'] in st.session_state.selected_ids, on_change=toggle_selection, args=(item['id'],))
+                        with col_list[-2]:
+                            if thumbnails.get(item['id']): st.image(thumbnails[item['id']], width=100)
+                            elif item.get('type') == 'pdf':
+                                 st.markdown("<p style='font-size: 48px;'>📑</p>", unsafe_allow_html=True)
+                            elif item.get('type') == 'text' and 'content' in item: st.info(item.get('content'))
+                            elif item.get('type') == 'text': st.markdown("<p style='font-size: 48px;'>📄</p>", unsafe_allow_html=True)
+                        with col_list[-1]:
+                            st.write(item.get('filename'))
+                            if st.session_state.organize_mode and item['type'] == 'pdf':
+                               split_context = {'folder_id': st.session_state.current_folder_id, 'item_id': item['id']}
+                               if st.button("Dela upp ✂️", key=f"split_{item['id']}", disabled=get_job_runner().is_active(job_owner(), 'split', split_context)):
+                                    submit_job('split', pdf_motor.split_pdf_and_upload, st.session_state.drive_service, item['id'], item['filename'], st.session_state.current_folder_id,
+                                                            cache=st.session_state.drive_cache, context=split_context)
+                                    st.rerun()
+                    st.divider()
+            else:
+                st.info("⬅️ Använd filbläddraren för att börja.")
@@ -0,0 +1,48 @@
+import pytest
+
+import drive_metrics
+import pdf_motor
+from fake_drive import FakeDriveService
+
+
+def build_story_folder(service, file_count):
+    folder_id = service.add_folder("berättelse")
+    for i in range(file_count):
+        if i % 2: service.add_file(f"bild_{i:04}.jpg", b'\xff\xd8\xff', parent_id=folder_id, mime_type='image/jpeg')
+        else: service.add_file(f"text_{i:04}.txt", f"Bildtext {i}".encode('utf-8'), parent_id=folder_id, mime_type='text/plain')
+    return folder_id
+
+
+def list_calls(action):
+    return action.summary()['methods']['files.list']['calls']
+
+
+@pytest.mark.parametrize('max_page_size', [1000, 300])
+def test_get_content_units_follows_all_pages(max_page_size):
+    service = FakeDriveService(max_page_size=max_page_size)
+    folder_id = build_story_folder(service, 5000)
+    with drive_metrics.measure('test') as action:
+        result = pdf_motor.get_content_units_from_folder(service, folder_id)
+    assert 'error' not in result
+    assert len(result['units']) == 5000
+    assert {unit['filename'] for unit in result['units']} == {f"text_{i:04}.txt" if i % 2 == 0 else f"bild_{i:04}.jpg" for i in range(5000)}
+    assert list_calls(action) == -(-5000 // max_page_size)
+
+
+def test_iter_content_units_yields_one_result_per_page():
+    service = FakeDriveService(max_page_size=1000)
+    folder_id = build_story_folder(service, 5000)
+    pages = [result for result in pdf_motor.iter_content_units_from_folder(service, folder_id) if 'units' in result]
+    assert len(pages) == 5
+    assert sum(len(page['units']) for page in pages) == 5000
+
+
+def test_list_folders_follows_next_page_token():
+    service = FakeDriveService(max_page_size=100)
+    parent_id = service.add_folder("förälder")
+    folder_ids = {service.add_folder(f"mapp_{i:03}", parent_id) for i in range(250)}
+    service.add_file("inte_en_mapp.txt", b'x', parent_id=parent_id, mime_type='text/plain')
+    with drive_metrics.measure('test') as action:
+        folders = pdf_motor.list_folders(service, parent_id)
+    assert {folder['id'] for folder in folders} == folder_ids
+    assert list_calls(action) == 3
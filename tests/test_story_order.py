@@ -0,0 +1,62 @@
+import json
+import io
+import threading
+
+from googleapiclient.http import MediaIoBaseUpload
+
+import pdf_motor
+from fake_drive import FakeDriveService
+
+
+def build_project_folder(service):
+    folder_id = service.add_folder("berättelse")
+    items = [{'id': service.add_file(f"bild_{i}.jpg", b'\xff\xd8\xff', parent_id=folder_id, mime_type='image/jpeg'), 'filename': f"bild_{i}.jpg"} for i in range(3)]
+    content = json.dumps({'order': [item['filename'] for item in items], 'ids': [item['id'] for item in items]}).encode('utf-8')
+    project_file_id = service.add_file(pdf_motor.PROJECT_FILE_NAME, content, parent_id=folder_id, mime_type='application/json')
+    project_file = service.files().get(fileId=project_file_id, fields='id, md5Checksum, modifiedTime').execute()
+    return folder_id, items, project_file
+
+
+def read_project(service, project_file_id):
+    return json.loads(pdf_motor.download_file_bytes(service, project_file_id).decode('utf-8'))
+
+
+def test_flush_saves_the_latest_order():
+    service = FakeDriveService()
+    folder_id, items, project_file = build_project_folder(service)
+    writer = pdf_motor.StoryOrderWriter(service, folder_id, project_file, delay=60)
+    writer.schedule(items)
+    writer.schedule(list(reversed(items)))
+    result = writer.flush()
+    assert result.get('success')
+    assert read_project(service, project_file['id'])['order'] == [item['filename'] for item in reversed(items)]
+
+
+def test_flush_reports_conflict_when_project_file_changed_since_load():
+    service = FakeDriveService()
+    folder_id, items, project_file = build_project_folder(service)
+    writer = pdf_motor.StoryOrderWriter(service, folder_id, project_file, delay=60)
+    # Någon annan sparar projektfilen efter att vi läst in mappen
+    theirs = json.dumps({'order': ['bild_2.jpg'], 'ids': [items[2]['id']]}).encode('utf-8')
+    service.files().update(fileId=project_file['id'], media_body=MediaIoBaseUpload(io.BytesIO(theirs), mimetype='application/json')).execute()
+    writer.schedule(list(reversed(items)))
+    result = writer.flush()
+    assert result.get('conflict') is True
+    assert 'error' in result
+    assert read_project(service, project_file['id']) == json.loads(theirs)
+
+
+def test_schedule_does_not_wait_for_a_running_write():
+    service = FakeDriveService(latency=0.5)
+    folder_id, items, project_file = build_project_folder(service)
+    writer = pdf_motor.StoryOrderWriter(service, folder_id, project_file, delay=60)
+    writer.schedule(items[1:])
+    flushing = threading.Thread(target=writer.flush)
+    flushing.start()
+    while not writer._write_lock.locked(): pass
+    scheduled = threading.Event()
+    threading.Thread(target=lambda: (writer.schedule(items), scheduled.set())).start()
+    assert scheduled.wait(0.2)
+    flushing.join()
+    assert writer.flush().get('success')
+    assert read_project(service, project_file['id'])['order'] == [item['filename'] for item in items]